@@ -8,21 +8,126 @@ import traceback
 import time
 import json
 import threading
-from datetime import datetime, timedelta, timezone
+import queue
+import atexit
+import logging.handlers
+import base64
+import hashlib
+import re
+import csv
+import shlex
+import tempfile
+import gzip
+import argparse
+import contextlib
+import contextvars
+import gc
+import sqlite3
+import math
+import heapq
+from collections import namedtuple, OrderedDict, defaultdict, Counter
+from decimal import Decimal, InvalidOperation
+from datetime import date, datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from functools import wraps
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
-from telegram.error import NetworkError, TimedOut, RetryAfter
+from functools import wraps, lru_cache
+from types import SimpleNamespace
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, InlineQueryHandler, filters, CallbackContext, CallbackQueryHandler, BaseUpdateProcessor
+from telegram.error import NetworkError, TimedOut, RetryAfter, BadRequest, Forbidden
+from telegram.request import BaseRequest, HTTPXRequest
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
 # ===== Логирование =====
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# .env читаем до настройки логов, чтобы LOG_FORMAT из него тоже учитывался
+load_dotenv()
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "5"))  # сообщений с одним rate_key за окно
+LOG_RATE_WINDOW = 60.0  # секунд
+
+_STANDARD_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra=... попадают в объект как есть"""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_FIELDS and key != 'rate_key':
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Пропускает не больше LOG_RATE_LIMIT записей с одинаковым rate_key за окно.
+
+    Записи без rate_key не ограничиваются. Число подавленных дописывается к
+    первой записи следующего окна.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._buckets = {}  # rate_key -> [начало окна, пропущено, подавлено]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'rate_key', None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or now - bucket[0] >= self.window:
+                suppressed = bucket[2] if bucket else 0
+                self._buckets[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} (подавлено похожих: {suppressed})"
+                    record.args = None
+                return True
+            if bucket[1] < self.limit:
+                bucket[1] += 1
+                return True
+            bucket[2] += 1
+            return False
+
+
+def setup_logging():
+    """Логи пишутся в stderr фоновым потоком через QueueHandler/QueueListener,
+    чтобы event loop не блокировался на записи. stdout остаётся за
+    результатами --dry-run и --replay"""
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 # Уменьшаем шум от httpx/httpcore
 logging.getLogger('httpx').setLevel(logging.WARNING)
@@ -65,20 +170,43 @@ def check_single_instance():
         return False
 
 # ===== Загрузка конфигурации =====
-load_dotenv()
-
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+# Поток изменений таблицы: "" (выключен), "realtime" (Supabase Realtime) или "postgres" (LISTEN/NOTIFY)
+CHANGE_FEED = os.getenv("CHANGE_FEED", "").strip().lower()
+CHANGE_FEED_DSN = os.getenv("CHANGE_FEED_DSN")
+CHANGE_FEED_CHANNEL = os.getenv("CHANGE_FEED_CHANNEL", "services_changes")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
+
+def parse_id_list(value):
+    """'123, -100456' -> [123, -100456]"""
+    return [int(x) for x in (value or "").replace(";", ",").split(",") if x.strip()]
+
+
+# Роли: admin — всё, viewer — только просмотр (команды отчётов, без кнопок-действий).
+# ADMIN_ID оставлен для совместимости и добавляется к ADMIN_IDS.
+ADMIN_IDS = list(dict.fromkeys(([ADMIN_ID] if ADMIN_ID else []) + parse_id_list(os.getenv("ADMIN_IDS"))))
+VIEWER_IDS = parse_id_list(os.getenv("VIEWER_IDS"))
+# Чаты (в т.ч. группы), куда рассылаются уведомления: все админы + NOTIFY_CHAT_IDS
+BROADCAST_CHATS = list(dict.fromkeys(ADMIN_IDS + parse_id_list(os.getenv("NOTIFY_CHAT_IDS"))))
+ROLE_LEVELS = {'viewer': 1, 'admin': 2}
+ROLES = {**{uid: 'viewer' for uid in VIEWER_IDS}, **{uid: 'admin' for uid in ADMIN_IDS}}
+
+
+def has_role(user_id, role):
+    """Есть ли у пользователя роль не ниже указанной"""
+    return ROLE_LEVELS.get(ROLES.get(user_id), 0) >= ROLE_LEVELS[role]
+
 # ===== Глобальные переменные =====
 bot_start_time = None
 total_checks = 0
 total_notifications = 0
 bot_application = None
 scheduler_running = True
-STATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'stats.json')
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+STATS_FILE = os.path.join(DATA_DIR, 'stats.json')
 
 def validate_config():
     """Проверяет конфигурацию при старте"""
@@ -89,8 +217,14 @@ def validate_config():
         errors.append("SUPABASE_URL не установлен")
     if not SUPABASE_KEY:
         errors.append("SUPABASE_KEY не установлен")
-    if ADMIN_ID == 0:
-        logger.warning("⚠️ ADMIN_ID не установлен — бот не будет отправлять уведомления и команды будут недоступны!")
+    if CHANGE_FEED not in ("", "realtime", "postgres"):
+        errors.append(f"CHANGE_FEED={CHANGE_FEED}: ожидается realtime или postgres")
+    if CHANGE_FEED == "postgres" and not CHANGE_FEED_DSN:
+        errors.append("CHANGE_FEED=postgres требует CHANGE_FEED_DSN")
+    if not ADMIN_IDS:
+        logger.warning("⚠️ ADMIN_ID/ADMIN_IDS не установлены — команды и кнопки будут недоступны!")
+    if not BROADCAST_CHATS:
+        logger.warning("⚠️ Нет получателей уведомлений — бот не будет отправлять уведомления!")
     if errors:
         for e in errors:
             logger.critical(f"❌ {e}")
@@ -119,6 +253,17 @@ def save_stats():
     except Exception as e:
         logger.warning(f"Не удалось сохранить статистику: {e}")
 
+
+# Счётчики ошибок и повторов с запуска: прогоны пишут в историю их приращение
+run_counters = Counter()
+_run_counters_lock = threading.Lock()
+
+
+def count_event(name, n=1):
+    """Увеличивает счётчик (вызывается и из потоков БД)"""
+    with _run_counters_lock:
+        run_counters[name] += n
+
 # ===== Supabase с автопереподключением =====
 supabase: Client = None
 
@@ -150,15 +295,26 @@ def db_query(func):
     """Декоратор для запросов к БД с retry и переподключением"""
     @wraps(func)
     def wrapper(*args, **kwargs):
+        if traffic_replay is not None:
+            return traffic_replay.db_result(func.__name__, args)
+        started = time.monotonic()
         last_error = None
         for attempt in range(3):
             try:
-                return func(*args, **kwargs)
+                result = func(*args, **kwargs)
+                if traffic_recorder is not None:
+                    traffic_recorder.record_db(func.__name__, args, result, time.monotonic() - started)
+                return result
             except Exception as e:
                 last_error = e
-                logger.warning(f"DB запрос {func.__name__} попытка {attempt+1}/3: {e}")
+                logger.warning(
+                    f"DB запрос {func.__name__} попытка {attempt+1}/3: {e}",
+                    extra={'rate_key': f"db_retry:{func.__name__}"}
+                )
                 if attempt < 2:
+                    count_event('db_retries')
                     reconnect_supabase()
+        count_event('db_errors')
         logger.error(f"DB запрос {func.__name__} провалился после 3 попыток: {last_error}")
         raise last_error
     return wrapper
@@ -188,47 +344,39 @@ def db_fetch_service_name(sid):
 @db_query
 def db_update_service(sid, data):
     """Обновить сервис по ID"""
-    return get_supabase().table("digital_notificator_services").update(data).eq("id", sid).execute()
-
-@db_query
-def db_bulk_update_services(ids, data):
-    """Массовое обновление сервисов по списку ID"""
-    return get_supabase().table("digital_notificator_services").update(data).in_("id", ids).execute()
-
-@db_query
-def db_fetch_projects():
-    """Получить список проектов"""
-    resp = get_supabase().table("digital_notificator_services").select("project").not_.is_("project", "null").execute()
-    return sorted(set(s.get('project') for s in (resp.data or []) if s.get('project')))
-
-@db_query
-def db_fetch_providers():
-    """Получить список провайдеров"""
-    resp = get_supabase().table("digital_notificator_services").select("provider").not_.is_("provider", "null").execute()
-    return sorted(set(s.get('provider') for s in (resp.data or []) if s.get('provider')))
+    resp = get_supabase().table("digital_notificator_services").update(data).eq("id", sid).execute()
+    invalidate_snapshot()
+    return resp
 
 @db_query
-def db_fetch_by_project(project):
-    """Получить сервисы проекта"""
-    return get_supabase().table("digital_notificator_services").select("*").eq("project", project).execute().data or []
+def db_update_service_if(sid, data, **expected):
+    """Обновить сервис, только если поля не изменились с момента чтения.
+
+    Возвращает True, если строка обновлена, False — если её успели изменить.
+    """
+    q = get_supabase().table("digital_notificator_services").update(data).eq("id", sid)
+    for field, value in expected.items():
+        q = q.is_(field, "null") if value is None else q.eq(field, value)
+    resp = q.execute()
+    invalidate_snapshot()
+    return bool(resp.data)
 
 @db_query
-def db_fetch_by_provider(provider):
-    """Получить сервисы провайдера"""
-    return get_supabase().table("digital_notificator_services").select("*").eq("provider", provider).execute().data or []
+def db_bulk_update_services(ids, data):
+    """Массовое обновление сервисов по списку ID"""
+    resp = get_supabase().table("digital_notificator_services").update(data).in_("id", ids).execute()
+    invalidate_snapshot()
+    return resp
 
-# Инициализация при старте
-try:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    logger.error(f"Не удалось подключиться к Supabase при старте: {e}")
 
 # ===== Утилиты даты/времени =====
 MSK = ZoneInfo("Europe/Moscow")
+# Сдвиг часов: при воспроизведении записи бот «живёт» во времени записи
+clock_shift = timedelta(0)
 
 def get_current_datetime():
     """Текущее время МСК"""
-    return datetime.now(MSK)
+    return datetime.now(MSK) + clock_shift
 
 def get_current_date():
     """Текущая дата МСК"""
@@ -238,10 +386,16 @@ def get_current_datetime_iso():
     """Текущее время МСК в ISO формате"""
     return get_current_datetime().isoformat()
 
+@lru_cache(maxsize=8192)  # дат в таблице немного, а строк — много
 def parse_db_date(date_str):
     """Парсит дату из БД, возвращает date или None"""
     if not date_str:
         return None
+    try:
+        # Быстрый путь для ISO 'YYYY-MM-DD[T...]' — в разы быстрее strptime
+        return date.fromisoformat(date_str[:10])
+    except (ValueError, TypeError):
+        pass
     try:
         if 'T' in date_str:
             date_str = date_str.split('T')[0]
@@ -249,6 +403,693 @@ def parse_db_date(date_str):
     except (ValueError, TypeError):
         return None
 
+# ===== Категории сервисов =====
+CATEGORY_RULES_FILE = os.path.join(DATA_DIR, 'categories.json')
+
+# Порядок важен: при нескольких совпадениях побеждает правило выше
+DEFAULT_CATEGORY_RULES = [
+    {
+        "category": "domain",
+        "keywords": ["домен", "domain"],
+        "patterns": [r"(?<![\w.-])[\w-]+(?:\.[\w-]+)*\.(?:ru|рф|su|com|net|org|io|info|biz|pro|online|site|store|shop|tech|app|dev|me)(?![\w-])"],
+        "providers": ["доменный регистратор", "reg.ru", "nic.ru", "r01", "regru"],
+    },
+    {
+        "category": "hosting",
+        "keywords": ["хостинг", "hosting", "vps", "vds", "сервер", "server"],
+        "patterns": [],
+        "providers": ["хостинг", "хостинг-провайдер", "timeweb", "beget", "selectel", "hetzner"],
+    },
+]
+
+
+class CategoryClassifier:
+    """Определяет категорию сервиса по имени и провайдеру.
+
+    Все ключевые слова и регулярки компилируются один раз в общий regex с
+    именованной группой на каждое правило, поэтому имя сканируется за один
+    проход независимо от числа правил. Провайдеры сверяются по словарю.
+    """
+
+    def __init__(self, rules):
+        self.categories = []
+        self._providers = {}
+        alternatives = []
+        for i, rule in enumerate(rules):
+            category = rule["category"]
+            if category not in self.categories:
+                self.categories.append(category)
+            parts = [re.escape(k.lower()) for k in rule.get("keywords", [])]
+            parts += rule.get("patterns", [])
+            if parts:
+                alternatives.append(f"(?P<r{i}>{'|'.join(parts)})")
+            for p in rule.get("providers", []):
+                self._providers.setdefault(p.lower(), (i, category))
+        self._rules = [r["category"] for r in rules]
+        self._pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+    def classify(self, name, provider=None):
+        """Категория сервиса или None"""
+        best = None
+        if provider:
+            hit = self._providers.get(str(provider).strip().lower())
+            if hit:
+                best = hit[0]
+        if name and self._pattern is not None:
+            for m in self._pattern.finditer(str(name).lower()):
+                rule = int(m.lastgroup[1:])
+                if best is None or rule < best:
+                    best = rule
+                if best == 0:
+                    break
+        return self._rules[best] if best is not None else None
+
+
+def load_category_rules():
+    """Правила из data/categories.json или встроенные по умолчанию"""
+    try:
+        if os.path.exists(CATEGORY_RULES_FILE):
+            with open(CATEGORY_RULES_FILE, 'r', encoding='utf-8') as f:
+                rules = json.load(f)
+            logger.info(f"Правил категорий загружено: {len(rules)}")
+            return rules
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить правила категорий: {e}")
+    return DEFAULT_CATEGORY_RULES
+
+
+category_classifier = CategoryClassifier(load_category_rules())
+
+
+# ===== Колоночный снимок сервисов =====
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен — без него снимок работает на списках
+    np = None
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # openpyxl нужен только для /export xlsx
+    Workbook = None
+
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL", "60"))  # секунд
+EXPIRING_DAYS = 30
+
+
+_COST_SPACES = str.maketrans({' ': None, '\u00a0': None, '\u202f': None, ',': '.'})
+
+
+def normalize_cost(value):
+    """'1 000,50' -> '1000.50': общий разбор для parse_cost и parse_decimal"""
+    return str(value).translate(_COST_SPACES)
+
+
+def parse_cost(value):
+    """Парсит стоимость из БД, возвращает float (0.0 если пусто/некорректно)"""
+    if value is None or value == '':
+        return 0.0
+    try:
+        cost = float(normalize_cost(value))
+    except (ValueError, TypeError):
+        return 0.0
+    return cost if math.isfinite(cost) else 0.0
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Service:
+    """Строка таблицы сервисов с разобранными полями.
+
+    Даты и стоимость парсятся один раз при загрузке, статус/проект/провайдер
+    интернируются — тысячи строк делят одни и те же объекты str. __slots__
+    вместо dict на строку заметно экономит память при больших таблицах.
+    """
+
+    __slots__ = (
+        'id', 'name', 'project', 'provider', 'status', 'user_id',
+        'expires_at', 'expires', 'cost', 'cost_value',
+        'notification_date', 'last_notification', 'payment_date',
+    )
+
+    def __init__(self, row):
+        self.id = row.get('id')
+        self.name = row.get('name')
+        self.project = _intern(row.get('project'))
+        self.provider = _intern(row.get('provider'))
+        self.status = _intern(row.get('status'))
+        self.user_id = row.get('user_id')
+        self.expires_at = row.get('expires_at')  # как в БД — для вывода
+        self.expires = parse_db_date(self.expires_at)
+        self.cost = row.get('cost')  # как в БД — для вывода и Decimal-аналитики
+        self.cost_value = parse_cost(self.cost)
+        self.notification_date = parse_db_date(row.get('notification_date'))
+        self.last_notification = _intern(row.get('last_notification'))
+        self.payment_date = row.get('payment_date')
+
+    @classmethod
+    def from_rows(cls, rows):
+        return [cls(r) for r in rows]
+
+    def days_left(self, today):
+        return (self.expires - today).days if self.expires else None
+
+    def __repr__(self):
+        return f"Service(id={self.id!r}, name={self.name!r}, status={self.status!r})"
+
+
+# (имя, провайдер) -> категория для пар из последнего снимка
+_category_memo = {}
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _datetime64_days(dates):
+    """date/None -> datetime64[D] с NaT; через ординалы, без поэлементного
+    разбора date в numpy (он в ~15 раз медленнее)"""
+    nat = np.iinfo(np.int64).min
+    days = np.fromiter(
+        (d.toordinal() - _EPOCH_ORDINAL if d else nat for d in dates),
+        dtype=np.int64, count=len(dates)
+    )
+    return days.view('datetime64[D]')
+
+
+def _categorize(values):
+    """Кодирует значения в категории: (список категорий, коды; -1 для пустых)"""
+    index = {}
+    categories = []
+    codes = []
+    for v in values:
+        if not v:
+            codes.append(-1)
+            continue
+        code = index.get(v)
+        if code is None:
+            code = index[v] = len(categories)
+            categories.append(v)
+        codes.append(code)
+    return categories, codes
+
+
+Facet = namedtuple('Facet', 'name count active_cost nearest_expiry')
+
+
+class ServiceSnapshot:
+    """Снимок таблицы сервисов в колоночном виде.
+
+    Строки — объекты Service с уже разобранными датами и стоимостью,
+    статус/проект/провайдер хранятся как коды категорий. С numpy группировки и корзины по сроку
+    считаются векторно, без numpy — одним проходом по спискам.
+    """
+
+    def __init__(self, rows, version=0):
+        self.rows = rows
+        self.version = version
+        self.created_at = time.monotonic()
+        self.generation = 0  # поколение записей в БД, которое снимок видел
+        self.fingerprint = None  # хэш исходных строк: тот же — версия не меняется
+        self.costs = None  # CostTotals этой версии, выставляется под _snapshot_lock
+        self._facets = {}
+        self._index = None  # id -> позиция строки, строится при первом patched()
+        self.statuses, status_codes = _categorize([r.status for r in rows])
+        self.projects, project_codes = _categorize([r.project for r in rows])
+        self.providers, provider_codes = _categorize([r.provider for r in rows])
+        self.categories, category_codes = _categorize(self._classify_rows(rows))
+        dates = [r.expires for r in rows]
+        costs = [r.cost_value for r in rows]
+
+        if np is not None:
+            self.status_codes = np.array(status_codes, dtype=np.int32)
+            self.project_codes = np.array(project_codes, dtype=np.int32)
+            self.provider_codes = np.array(provider_codes, dtype=np.int32)
+            self.category_codes = np.array(category_codes, dtype=np.int32)
+            self.cost = np.array(costs, dtype=np.float64)
+            self.expires = _datetime64_days(dates)
+        else:
+            self.status_codes = status_codes
+            self.project_codes = project_codes
+            self.provider_codes = provider_codes
+            self.category_codes = category_codes
+            self.cost = costs
+            self.expires = dates
+
+    def __len__(self):
+        return len(self.rows)
+
+    _COLUMNS = ('status_codes', 'project_codes', 'provider_codes', 'category_codes', 'cost', 'expires')
+
+    @staticmethod
+    def _add_code(categories, value):
+        """Код значения; новое значение дописывается в категории"""
+        if not value:
+            return -1
+        try:
+            return categories.index(value)
+        except ValueError:
+            categories.append(value)
+            return len(categories) - 1
+
+    def _row_values(self, r):
+        """Значения колонок для одной строки (в порядке _COLUMNS)"""
+        key = (r.name, r.provider)
+        category = _category_memo.get(key)
+        if category is None:
+            category = _category_memo[key] = category_classifier.classify(*key)
+        return (
+            self._add_code(self.statuses, r.status),
+            self._add_code(self.projects, r.project),
+            self._add_code(self.providers, r.provider),
+            self._add_code(self.categories, category),
+            r.cost_value,
+            r.expires,
+        )
+
+    def patched(self, services, deleted, version):
+        """Новый снимок с заменёнными, добавленными и удалёнными строками.
+
+        Разбираются и классифицируются только переданные строки; остальное —
+        копии списков и массивов, так что читатели текущего снимка не видят
+        его наполовину изменённым.
+        """
+        clone = object.__new__(ServiceSnapshot)
+        clone.__dict__.update(self.__dict__)
+        clone.version = version
+        clone.fingerprint = None
+        clone.costs = None
+        clone._facets = {}
+        for name in ('statuses', 'projects', 'providers', 'categories'):
+            setattr(clone, name, list(getattr(self, name)))
+        if self._index is None:
+            self._index = {r.id: i for i, r in enumerate(self.rows)}
+        index = self._index
+        rows = self.rows
+        columns = {name: getattr(self, name) for name in self._COLUMNS}
+
+        gone = sorted(index[sid] for sid in deleted if sid in index)
+        if gone:
+            dropped = set(gone)
+            keep = [i for i in range(len(rows)) if i not in dropped]
+            rows = [rows[i] for i in keep]
+            if np is not None:
+                columns = {name: np.delete(c, gone) for name, c in columns.items()}
+            else:
+                columns = {name: [c[i] for i in keep] for name, c in columns.items()}
+            index = {r.id: i for i, r in enumerate(rows)}
+        else:
+            rows = list(rows)
+            columns = {name: c.copy() if np is not None else list(c) for name, c in columns.items()}
+            index = dict(index)
+
+        appended = []
+        for r in services:
+            values = clone._row_values(r)
+            i = index.get(r.id)
+            if i is None:
+                index[r.id] = len(rows)
+                rows.append(r)
+                appended.append(values)
+                continue
+            rows[i] = r
+            for name, value in zip(self._COLUMNS, values):
+                if name == 'expires' and np is not None:
+                    value = np.datetime64(value, 'D') if value else np.datetime64('NaT')
+                columns[name][i] = value
+        if appended:
+            for name, values in zip(self._COLUMNS, zip(*appended)):
+                if np is None:
+                    columns[name].extend(values)
+                elif name == 'expires':
+                    columns[name] = np.concatenate([columns[name], _datetime64_days(values)])
+                else:
+                    columns[name] = np.concatenate([columns[name], np.array(values, dtype=columns[name].dtype)])
+
+        clone.rows = rows
+        clone._index = index
+        for name, column in columns.items():
+            setattr(clone, name, column)
+        return clone
+
+    @staticmethod
+    def _classify_rows(rows):
+        """Категория каждой строки; одинаковые (имя, провайдер) считаются один раз.
+
+        Категории переносятся из предыдущего снимка, так что при обновлении
+        по SNAPSHOT_TTL правила прогоняются только для новых пар. Снимки
+        строятся под _snapshot_lock.
+        """
+        global _category_memo
+        previous = _category_memo
+        memo = {}
+        result = []
+        for r in rows:
+            key = (r.name, r.provider)
+            category = memo.get(key, memo)
+            if category is memo:
+                category = previous.get(key, memo)
+                if category is memo:
+                    category = category_classifier.classify(*key)
+                memo[key] = category
+            result.append(category)
+        _category_memo = memo
+        return result
+
+    def _field(self, field):
+        """Категории и коды для поля 'project' / 'provider' / 'category'"""
+        if field == 'project':
+            return self.projects, self.project_codes
+        if field == 'provider':
+            return self.providers, self.provider_codes
+        if field == 'category':
+            return self.categories, self.category_codes
+        raise ValueError(f"Нет фасета для поля {field}")
+
+    def _code(self, categories, value):
+        try:
+            return categories.index(value)
+        except ValueError:
+            return -2  # заведомо не совпадёт ни с одним кодом
+
+    def status_counts(self):
+        """Количество сервисов по статусам: {status: count}"""
+        if np is not None:
+            valid = self.status_codes[self.status_codes >= 0]
+            counts = np.bincount(valid, minlength=len(self.statuses))
+            return {s: int(c) for s, c in zip(self.statuses, counts)}
+        counts = dict.fromkeys(self.statuses, 0)
+        for code in self.status_codes:
+            if code >= 0:
+                counts[self.statuses[code]] += 1
+        return counts
+
+    def facets(self, field):
+        """Фасеты по проекту/провайдеру, отсортированные по имени.
+
+        Для каждого значения: число сервисов, стоимость активных и ближайшая
+        дата окончания среди активных. Считается один раз на снимок.
+        """
+        if field in self._facets:
+            return self._facets[field]
+        categories, codes = self._field(field)
+        n = len(categories)
+        active = self._code(self.statuses, 'active')
+
+        if np is not None:
+            valid = codes >= 0
+            counts = np.bincount(codes[valid], minlength=n)
+            is_active = valid & (self.status_codes == active)
+            costs = np.bincount(codes[is_active], weights=self.cost[is_active], minlength=n)
+            dated = is_active & ~np.isnat(self.expires)
+            nearest = np.full(n, np.datetime64('NaT'), dtype='datetime64[D]')
+            if dated.any():
+                days = self.expires[dated].astype(np.int64)
+                best = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+                np.minimum.at(best, codes[dated], days)
+                has = best != np.iinfo(np.int64).max
+                nearest[has] = best[has].astype('datetime64[D]')
+            counts, costs, nearest = counts.tolist(), costs.tolist(), nearest.tolist()
+        else:
+            counts, costs, nearest = [0] * n, [0.0] * n, [None] * n
+            for i, code in enumerate(codes):
+                if code < 0:
+                    continue
+                counts[code] += 1
+                if self.status_codes[i] != active:
+                    continue
+                costs[code] += self.cost[i]
+                exp = self.expires[i]
+                if exp and (nearest[code] is None or exp < nearest[code]):
+                    nearest[code] = exp
+
+        result = sorted(
+            (Facet(name, counts[c], costs[c], nearest[c]) for c, name in enumerate(categories)),
+            key=lambda f: f.name
+        )
+        self._facets[field] = result
+        return result
+
+    def facet(self, field, value):
+        """Один фасет по значению (или None)"""
+        for f in self.facets(field):
+            if f.name == value:
+                return f
+        return None
+
+    def select(self, field, value):
+        """Строки снимка с заданным проектом/провайдером"""
+        categories, codes = self._field(field)
+        code = self._code(categories, value)
+        if np is not None:
+            return [self.rows[i] for i in np.flatnonzero(codes == code).tolist()]
+        return [r for r, c in zip(self.rows, codes) if c == code]
+
+    def classify(self, today, status='active', horizon=EXPIRING_DAYS, categories=None):
+        """Раскладывает сервисы со статусом (и категорией из набора) по срокам.
+
+        Возвращает dict с ключами 'expired', 'expiring', 'ok' — списки кортежей
+        (row, exp_date, days, cost), отсортированные по days.
+        """
+        code = self._code(self.statuses, status) if status else None
+        category_codes = None
+        if categories is not None:
+            category_codes = {self._code(self.categories, c) for c in categories}
+        if np is not None:
+            mask = ~np.isnat(self.expires)
+            if code is not None:
+                mask &= self.status_codes == code
+            if category_codes is not None:
+                mask &= np.isin(self.category_codes, list(category_codes))
+            idx = np.flatnonzero(mask)
+            days = (self.expires[idx] - np.datetime64(today, 'D')).astype(np.int64)
+            order = np.argsort(days, kind='stable')
+            idx, days = idx[order], days[order]
+            bounds = np.searchsorted(days, [0, horizon + 1])
+            dates = self.expires[idx].tolist()
+            costs = self.cost[idx].tolist()
+            entries = [
+                (self.rows[i], d, n, c)
+                for i, d, n, c in zip(idx.tolist(), dates, days.tolist(), costs)
+            ]
+            return {
+                'expired': entries[:bounds[0]],
+                'expiring': entries[bounds[0]:bounds[1]],
+                'ok': entries[bounds[1]:],
+            }
+
+        result = {'expired': [], 'expiring': [], 'ok': []}
+        for i, exp in enumerate(self.expires):
+            if exp is None or (code is not None and self.status_codes[i] != code):
+                continue
+            if category_codes is not None and self.category_codes[i] not in category_codes:
+                continue
+            days = (exp - today).days
+            key = 'expired' if days < 0 else 'expiring' if days <= horizon else 'ok'
+            result[key].append((self.rows[i], exp, days, self.cost[i]))
+        for entries in result.values():
+            entries.sort(key=lambda x: x[2])
+        return result
+
+
+# ===== Аналитика стоимости =====
+FORECAST_WINDOWS = (30, 90, 365)
+NO_PROJECT = "—"
+
+
+def parse_decimal(value):
+    """Стоимость из БД как Decimal (None если пусто/некорректно)"""
+    if value is None or value == '':
+        return None
+    try:
+        cost = Decimal(normalize_cost(value))
+    except (InvalidOperation, ValueError):
+        return None
+    return cost if cost.is_finite() else None
+
+
+class CostTotals(namedtuple('CostTotals', 'total by_project by_provider by_month by_date')):
+    """Неизменяемые суммы стоимости одной версии снимка (snapshot.costs).
+
+    Обработчики читают их в event loop, пока CostAnalytics в рабочем
+    потоке уже считает следующую версию.
+    """
+    __slots__ = ()
+
+    def forecast(self, today, days):
+        """Стоимость продлений с окончанием в [today, today + days]"""
+        end = today + timedelta(days=days)
+        return sum((v for d, v in self.by_date.items() if today <= d <= end), Decimal(0))
+
+    def overdue(self, today):
+        """Стоимость уже истёкших, но активных сервисов"""
+        return sum((v for d, v in self.by_date.items() if d < today), Decimal(0))
+
+
+class CostAnalytics:
+    """Материализованные суммы стоимости активных сервисов.
+
+    Агрегаты по проекту, провайдеру, месяцу и дате окончания обновляются
+    инкрементально: при новом снимке пересчитываются только строки, у
+    которых изменились статус/проект/провайдер/дата/стоимость, поэтому
+    Decimal парсится один раз на версию строки. Меняется только под
+    _snapshot_lock; наружу отдаются копии (totals()).
+    """
+
+    def __init__(self):
+        self._rows = {}  # id -> (сырые поля, вклад или None)
+        self.version = None
+        self.total = Decimal(0)
+        self.by_project = defaultdict(Decimal)
+        self.by_provider = defaultdict(Decimal)
+        self.by_month = defaultdict(Decimal)
+        self.by_date = defaultdict(Decimal)
+
+    @staticmethod
+    def _contribution(raw):
+        status, project, provider, expires, cost = raw
+        if status != 'active':
+            return None
+        cost = parse_decimal(cost)
+        if not cost:
+            return None
+        return project or NO_PROJECT, provider or NO_PROJECT, expires, cost
+
+    def _add(self, contribution, sign):
+        if contribution is None:
+            return
+        project, provider, exp, cost = contribution
+        delta = cost if sign > 0 else -cost
+        self.total += delta
+        targets = [(self.by_project, project), (self.by_provider, provider)]
+        if exp:
+            targets += [(self.by_month, exp.strftime('%Y-%m')), (self.by_date, exp)]
+        for aggregate, key in targets:
+            aggregate[key] += delta
+            if not aggregate[key]:
+                del aggregate[key]
+
+    def apply(self, snapshot):
+        """Приводит агрегаты к снимку, пересчитывая только изменённые строки"""
+        if snapshot.version == self.version:
+            return
+        seen = set()
+        changed = 0
+        for r in snapshot.rows:
+            seen.add(r.id)
+            changed += self._update(r)
+        for sid in [sid for sid in self._rows if sid not in seen]:
+            self._add(self._rows.pop(sid)[1], -1)
+            changed += 1
+        self.version = snapshot.version
+        logger.debug(f"Аналитика стоимости: изменено строк {changed}")
+
+    def patch(self, services, deleted, version):
+        """То же для изменений из потока: трогаются только переданные строки"""
+        for sid in deleted:
+            old = self._rows.pop(sid, None)
+            if old is not None:
+                self._add(old[1], -1)
+        for r in services:
+            self._update(r)
+        self.version = version
+
+    def _update(self, r):
+        raw = (r.status, r.project, r.provider, r.expires, r.cost)
+        old = self._rows.get(r.id)
+        if old is not None and old[0] == raw:
+            return 0
+        if old is not None:
+            self._add(old[1], -1)
+        contribution = self._contribution(raw)
+        self._add(contribution, +1)
+        self._rows[r.id] = (raw, contribution)
+        return 1
+
+    def totals(self):
+        """Копия агрегатов для публикации вместе со снимком"""
+        return CostTotals(self.total, dict(self.by_project), dict(self.by_provider),
+                          dict(self.by_month), dict(self.by_date))
+
+
+cost_analytics = CostAnalytics()
+
+
+_snapshot = None
+_snapshot_version = 0
+# Растёт при каждой записи в БД (invalidate_snapshot). Снимок старого
+# поколения устарел, а выборка, во время которой прошла запись, повторяется
+_snapshot_generation = 0
+_generation_lock = threading.Lock()
+SNAPSHOT_FETCH_ATTEMPTS = 3
+# Снимок строят из рабочих потоков: одновременные запросы ждут одну выборку
+_snapshot_lock = threading.Lock()
+
+
+def _rows_fingerprint(rows):
+    """Хэш строк выборки (None, если в строках есть нехэшируемые значения)"""
+    try:
+        return hash(tuple(tuple(r.values()) for r in rows))
+    except TypeError:
+        return None
+
+
+def get_snapshot(max_age=SNAPSHOT_TTL):
+    """Возвращает кэшированный снимок, перечитывая БД если он старше max_age
+    или с тех пор была запись. Версия меняется, только если изменились строки."""
+    global _snapshot, _snapshot_version
+    requested = time.monotonic()
+    with _snapshot_lock:
+        snapshot = _snapshot
+        # Снимок, построенный пока мы ждали лок, тоже достаточно свежий
+        if (snapshot is not None and snapshot.generation == _snapshot_generation
+                and min(requested, time.monotonic() - max_age) <= snapshot.created_at):
+            return snapshot
+        for _ in range(SNAPSHOT_FETCH_ATTEMPTS):
+            generation = _snapshot_generation
+            raw = db_fetch_all_services()
+            if generation == _snapshot_generation:
+                break
+        fingerprint = _rows_fingerprint(raw)
+        if snapshot is not None and fingerprint is not None and fingerprint == snapshot.fingerprint:
+            snapshot.created_at = time.monotonic()
+        else:
+            _snapshot_version += 1
+            snapshot = ServiceSnapshot(Service.from_rows(raw), _snapshot_version)
+            snapshot.fingerprint = fingerprint
+            cost_analytics.apply(snapshot)
+            snapshot.costs = cost_analytics.totals()
+        # Если записи так и не прекратились — снимок останется устаревшим
+        snapshot.generation = generation
+        _snapshot = snapshot
+        return snapshot
+
+
+def patch_snapshot(services, deleted=()):
+    """Применяет к снимку изменения из потока, не перечитывая таблицу.
+
+    Время построения остаётся от последней полной выборки: пропущенные
+    потоком изменения всё равно подтянутся по SNAPSHOT_TTL.
+    """
+    global _snapshot, _snapshot_version
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if snapshot is None:
+            return  # следующий get_snapshot и так прочитает свежие данные
+        _snapshot_version += 1
+        patched = snapshot.patched(services, deleted, _snapshot_version)
+        if cost_analytics.version == snapshot.version:
+            cost_analytics.patch(services, deleted, patched.version)
+        else:
+            cost_analytics.apply(patched)
+        patched.costs = cost_analytics.totals()
+        _snapshot = patched
+
+
+def invalidate_snapshot():
+    """Помечает снимок устаревшим после записи в БД"""
+    global _snapshot_generation
+    with _generation_lock:
+        _snapshot_generation += 1
+
 def update_statistics(checks_increment=0, notifications_increment=0):
     """Обновляет статистику работы бота и сохраняет в файл"""
     global total_checks, total_notifications
@@ -263,22 +1104,27 @@ def esc(text):
     return str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
 
-def admin_only(func):
-    """Декоратор: команда доступна только админу"""
-    @wraps(func)
-    async def wrapper(update: Update, context: CallbackContext):
-        if update.message and update.message.from_user.id != ADMIN_ID:
-            await update.message.reply_text("❌ Доступ запрещён.")
-            return
-        return await func(update, context)
-    return wrapper
+def require_role(role):
+    """Декоратор: команда доступна пользователям с ролью не ниже role"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(update: Update, context: CallbackContext):
+            if update.message and not has_role(update.message.from_user.id, role):
+                await update.message.reply_text("❌ Доступ запрещён.")
+                return
+            return await func(update, context)
+        return wrapper
+    return decorator
 
 
-async def send_long_message(update, text, parse_mode='HTML'):
-    """Отправляет сообщение, разбивая на части если >4096 символов"""
+admin_only = require_role('admin')
+viewer_allowed = require_role('viewer')
+
+
+def split_message(text):
+    """Разбивает текст по строкам на части не длиннее лимита Telegram"""
     if len(text) <= 4096:
-        await update.message.reply_text(text, parse_mode=parse_mode)
-        return
+        return [text]
     parts = []
     current = ""
     for line in text.split("\n"):
@@ -289,27 +1135,561 @@ async def send_long_message(update, text, parse_mode='HTML'):
             current += line + "\n"
     if current:
         parts.append(current)
+    return [part.strip() for part in parts]
+
+
+async def send_long_message(update, text, parse_mode='HTML'):
+    """Отправляет сообщение, разбивая на части если >4096 символов"""
+    await send_parts(update, split_message(text), parse_mode)
+
+
+async def send_parts(update, parts, parse_mode='HTML'):
+    """Отправляет уже разбитый на части текст"""
     for part in parts:
-        await update.message.reply_text(part.strip(), parse_mode=parse_mode)
+        await update.message.reply_text(part, parse_mode=parse_mode)
+
+
+def append_footer(parts, footer):
+    """Дописывает строку к последней части (или отдельной частью, если не влезает)"""
+    if parts and len(parts[-1]) + len(footer) + 2 <= 4000:
+        return parts[:-1] + [f"{parts[-1]}\n\n{footer}"]
+    return list(parts) + [footer]
+
+
+# ===== Кэш отчётов =====
+REPORT_CACHE_LIMIT = 256
+
+
+class ReportCache:
+    """Готовый текст отчётов (/status, /check, проекты, провайдеры).
+
+    Запись действительна для версии снимка и даты, с которыми построена.
+    Версия меняется только вместе со строками, поэтому перечитывание по
+    SNAPSHOT_TTL без изменений кэш не сбрасывает.
+    """
+
+    def __init__(self, limit=REPORT_CACHE_LIMIT):
+        self.limit = limit
+        self._entries = OrderedDict()  # ключ -> ((версия, дата), значение)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, snapshot, render, today=None):
+        stamp = (snapshot.version, today)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        value = render()
+        self._entries[key] = (stamp, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.limit:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+report_cache = ReportCache()
+
+# ===== Токены callback-кнопок =====
+CALLBACK_TOKENS_FILE = os.path.join(DATA_DIR, 'callback_tokens.json')
+CALLBACK_TOKEN_LIMIT = 5000
+
+
+class CallbackTokenRegistry:
+    """Короткие токены для callback_data вместо длинных имён.
+
+    Токен — детерминированный 8-символьный хэш от (kind, key), поэтому одна
+    и та же сущность всегда получает одну и ту же кнопку. Сущность хранится
+    вместе с полезной нагрузкой (например, именем сервиса), чтобы обработчик
+    не ходил в БД. Реестр ограничен LRU и сохраняется в data/.
+    """
+
+    def __init__(self, path, limit=CALLBACK_TOKEN_LIMIT):
+        self.path = path
+        self.limit = limit
+        self._entities = OrderedDict()  # token -> entity dict
+        self._tokens = {}  # (kind, key) -> token
+        self._dirty = False
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    for token, entity in json.load(f).items():
+                        self._put(token, entity)
+                logger.info(f"Токенов callback загружено: {len(self._entities)}")
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить токены callback: {e}")
+        self._dirty = False
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._entities, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить токены callback: {e}")
+
+    def _put(self, token, entity):
+        old = self._entities.pop(token, None)
+        if old:
+            self._tokens.pop((old['kind'], old['key']), None)
+        self._entities[token] = entity
+        self._tokens[(entity['kind'], entity['key'])] = token
+        while len(self._entities) > self.limit:
+            _, evicted = self._entities.popitem(last=False)
+            self._tokens.pop((evicted['kind'], evicted['key']), None)
+
+    @staticmethod
+    def _make_token(kind, key, salt=0):
+        digest = hashlib.blake2b(f"{kind}\0{key}\0{salt}".encode('utf-8'), digest_size=6).digest()
+        return base64.urlsafe_b64encode(digest).decode('ascii')
+
+    def token_for(self, kind, key, **payload):
+        """Возвращает токен сущности, регистрируя/обновляя её при необходимости"""
+        key = str(key)
+        entity = {'kind': kind, 'key': key, **payload}
+        token = self._tokens.get((kind, key))
+        if token is None:
+            salt = 0
+            token = self._make_token(kind, key)
+            while token in self._entities:
+                salt += 1
+                token = self._make_token(kind, key, salt)
+        elif self._entities[token] == entity:
+            self._entities.move_to_end(token)
+            return token
+        self._put(token, entity)
+        self._dirty = True
+        return token
+
+    def resolve(self, token):
+        """Сущность по токену (или None, если токен неизвестен/вытеснен)"""
+        entity = self._entities.get(token)
+        if entity is not None:
+            self._entities.move_to_end(token)
+        return entity
+
+
+callback_tokens = CallbackTokenRegistry(CALLBACK_TOKENS_FILE)
+
+
+CALLBACK_DATA_LIMIT = 64  # байт, ограничение Telegram
+
+
+def service_ref(service):
+    """Ссылка на сервис для callback_data: сам id, если кнопки с ним влезают
+    в лимит, иначе '@<токен>' с закэшированным именем.
+
+    id не зависит от реестра токенов — кнопки старых напоминаний не устаревают.
+    """
+    sid = str(service.id)
+    longest = f"extend:{sid}:365:{_date_tag(date.max)}"  # самая длинная кнопка карточки
+    if ':' not in sid and not sid.startswith('@') and len(longest.encode('utf-8')) <= CALLBACK_DATA_LIMIT:
+        return sid
+    return "@" + callback_tokens.token_for('service', service.id, name=service.name)
+
+
+def resolve_service_ref(ref):
+    """Разбирает ссылку на сервис: (id, имя или None)"""
+    if ref.startswith("@"):
+        entity = callback_tokens.resolve(ref[1:])
+        if entity is None or entity['kind'] != 'service':
+            raise LookupError("Кнопка устарела — откройте список заново")
+        return entity['key'], entity.get('name')
+    return ref, None
+
+
+# ===== Исходящие сообщения =====
+SEND_RATE = float(os.getenv("SEND_RATE", "20"))  # сообщений в секунду
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "4"))  # одновременных запросов к Bot API
+SEND_MAX_RETRIES = 3
+SEND_BACKLOG_LIMIT = float(os.getenv("SEND_BACKLOG_LIMIT", "30"))  # секунд очереди — уже «давление»
+SEND_PRESSURE_COOLDOWN = 60.0  # секунд после flood control, пока откладываем низкий приоритет
+
+# Приоритет отправки: меньше — раньше. Срочные уведомления обгоняют заблаговременные
+SEND_PRIORITY = {"expired": 0, "daily": 1, "one_week": 3, "two_weeks": 4, "month": 5}
+PRIORITY_DEFAULT = 2  # служебные рассылки, ответы и прочее
+DEFERRABLE_PRIORITY = 3  # с этого приоритета уведомления можно отложить при давлении
+
+# Вызовы одного напоминания во все чаты (notify_and_mark) делят общий
+# SimpleNamespace(started=...): при остановке очередь снимает напоминание
+# целиком, если ни один его вызов ещё не начат
+send_batch = contextvars.ContextVar('send_batch', default=None)
+
+
+class SendDropped(Exception):
+    """Вызов снят с очереди при остановке: напоминание ещё не начинали слать"""
+
+
+class OutboundSender:
+    """Очередь исходящих сообщений с ограничением скорости.
+
+    Отправители кладут вызов в очередь с приоритетом и ждут future с
+    результатом; run() держит SEND_CONCURRENCY воркеров, которые делят общий
+    темп 1/SEND_RATE. При RetryAfter пауза общая для всех воркеров, а вызов
+    возвращается в очередь — после паузы первым уйдёт самый срочный.
+    Очередь живёт дольше воркеров, поэтому перезапуск супервизором не теряет
+    сообщения. При остановке не начатые напоминания (send_batch) снимаются,
+    а начатые доходят до всех чатов — частичной рассылки не бывает.
+    """
+
+    def __init__(self, rate=SEND_RATE, concurrency=SEND_CONCURRENCY):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.concurrency = max(1, concurrency)
+        self.queue = asyncio.PriorityQueue()
+        self.running = False
+        self._next_slot = 0.0
+        self._seq = 0  # FIFO внутри одного приоритета
+        self.pressure_until = 0.0
+
+    async def call(self, method, priority=PRIORITY_DEFAULT, **kwargs):
+        """Ставит вызов метода Bot API (send_message, edit_message_text, ...) в очередь"""
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        await self.queue.put((priority, self._seq, method, kwargs, future, send_batch.get()))
+        return await future
+
+    async def send(self, chat_id, text, priority=PRIORITY_DEFAULT, **kwargs):
+        return await self.call('send_message', priority, chat_id=chat_id, text=text, **kwargs)
+
+    def under_pressure(self):
+        """Недавно был flood control или очередь больше SEND_BACKLOG_LIMIT секунд"""
+        loop = asyncio.get_running_loop()
+        return loop.time() < self.pressure_until or self.queue.qsize() * self.interval > SEND_BACKLOG_LIMIT
+
+    def _flood_pause(self, delay):
+        now = asyncio.get_running_loop().time()
+        self._next_slot = max(self._next_slot, now + delay)
+        self.pressure_until = max(self.pressure_until, now + delay + SEND_PRESSURE_COOLDOWN)
+
+    async def _deliver(self, method, kwargs):
+        for attempt in range(SEND_MAX_RETRIES):
+            try:
+                return await getattr(bot_application.bot, method)(**kwargs)
+            except (BadRequest, Forbidden):
+                raise  # постоянные ошибки (BadRequest — подкласс NetworkError)
+            except NetworkError as e:
+                # Таймаут send_* мог дойти до Telegram: повтор даст дубль
+                if attempt == SEND_MAX_RETRIES - 1 or (isinstance(e, TimedOut) and method.startswith('send')):
+                    raise
+                logger.warning(f"Сетевая ошибка при отправке, повтор: {e}", extra={'rate_key': 'send_network'})
+                count_event('send_retries')
+                await asyncio.sleep(2 ** attempt)
+        raise RuntimeError(f"Сообщение не отправлено после {SEND_MAX_RETRIES} попыток")
+
+    async def _pace(self):
+        """Общий для всех воркеров темп: не чаще одного запроса за interval"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            method, kwargs, future, batch = item[2:]
+            try:
+                if batch is not None and not batch.started:
+                    if stop_requested:
+                        raise SendDropped()
+                    batch.started = True
+                if not future.done():
+                    await self._pace()
+                    result = await self._deliver(method, kwargs)
+                    if not future.done():
+                        future.set_result(result)
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.warning(f"Flood control при отправке — пауза {delay} сек", extra={'rate_key': 'send_flood'})
+                self._flood_pause(delay)
+                count_event('send_retries')
+                self.queue.put_nowait(item)
+            except asyncio.CancelledError:
+                # Вернём сообщение в очередь для следующего запуска воркеров
+                self.queue.put_nowait(item)
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def run(self):
+        self.running = True
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.running = False
+
+
+outbound = None
+
+
+class InflightTracker:
+    """Счётчик незавершённых операций (отправка + запись в БД и т.п.).
+
+    Используется как async-контекст; при остановке drain ждёт, пока
+    счётчик не обнулится. Не привязан к event loop, поэтому переживает
+    перезапуск main().
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    async def __aenter__(self):
+        self.count += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.count -= 1
+        return False
+
+    async def wait_idle(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.count > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.count == 0
+
+
+inflight = InflightTracker()
+
+
+# chat_id -> {'ok': n, 'failed': n, 'last_error': str|None}
+delivery_stats = defaultdict(lambda: {'ok': 0, 'failed': 0, 'last_error': None})
+
+
+async def bot_call(method, priority=PRIORITY_DEFAULT, **kwargs):
+    """Вызов Bot API через очередь (или напрямую, если воркеры не запущены)"""
+    if outbound is not None and outbound.running:
+        return await outbound.call(method, priority, **kwargs)
+    if bot_application:
+        return await getattr(bot_application.bot, method)(**kwargs)
+
+
+async def send_to_chat(chat_id, text, priority=PRIORITY_DEFAULT, **kwargs):
+    """Отправляет сообщение в чат через очередь"""
+    return await bot_call('send_message', priority, chat_id=chat_id, text=text, **kwargs)
+
+
+def send_pressure():
+    """Есть ли давление на исходящую очередь (flood control или длинный хвост)"""
+    return outbound is not None and outbound.running and outbound.under_pressure()
+
+
+async def broadcast(text, **kwargs):
+    """Рассылает сообщение всем получателям параллельно"""
+    return await fan_out(lambda chat_id: send_to_chat(chat_id, text, **kwargs))
+
+
+async def fan_out(deliver):
+    """Параллельно вызывает deliver(chat_id) для всех получателей.
+
+    Возвращает {chat_id: результат} только для успешно доставленных;
+    ошибки по каждому получателю учитываются в delivery_stats.
+    """
+    if not BROADCAST_CHATS:
+        return {}
+    results = await asyncio.gather(
+        *(deliver(chat_id) for chat_id in BROADCAST_CHATS),
+        return_exceptions=True
+    )
+    if any(isinstance(r, SendDropped) for r in results):
+        raise SendDropped()
+    delivered = {}
+    for chat_id, result in zip(BROADCAST_CHATS, results):
+        stats = delivery_stats[chat_id]
+        if isinstance(result, BaseException):
+            count_event('send_errors')
+            stats['failed'] += 1
+            stats['last_error'] = str(result)
+            logger.warning(f"Не доставлено в чат {chat_id}: {result}", extra={
+                'chat_id': chat_id, 'rate_key': f"delivery:{chat_id}"
+            })
+        else:
+            stats['ok'] += 1
+            delivered[chat_id] = result
+    return delivered
+
+
+# ===== Реестр сообщений-напоминаний =====
+MESSAGES_FILE = os.path.join(DATA_DIR, 'messages.json')
+MESSAGE_RETENTION_DAYS = 60
+# Типы, которые повторяются день за днём — их правим на месте, а не шлём заново
+EDIT_IN_PLACE_TYPES = ("daily", "expired")
+
+
+class MessageRegistry:
+    """Последнее напоминание по каждому сервису в каждом чате: message_id и тип.
+
+    Хранится в data/, чтобы после перезапуска правка продолжала работать.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}  # str(sid) -> {'date', 'chats': {str(chat_id): [message_id, тип]}}
+        self._dirty = False
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    self._entries = json.load(f)
+                cutoff = (get_current_date() - timedelta(days=MESSAGE_RETENTION_DAYS)).isoformat()
+                self._entries = {k: v for k, v in self._entries.items() if v.get('date', '') >= cutoff}
+                logger.info(f"Сообщений-напоминаний загружено: {len(self._entries)}")
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить реестр сообщений: {e}")
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить реестр сообщений: {e}")
+
+    def get(self, sid, chat_id):
+        """(message_id, тип) последнего напоминания в чате или None"""
+        entry = self._entries.get(str(sid))
+        found = entry['chats'].get(str(chat_id)) if entry else None
+        return tuple(found) if found else None
+
+    def record(self, sid, chat_id, message_id, notification_type):
+        entry = self._entries.setdefault(str(sid), {'chats': {}})
+        entry['date'] = get_current_date().isoformat()
+        entry['chats'][str(chat_id)] = [message_id, notification_type]
+        self._dirty = True
+
+    def forget(self, sid):
+        """Убирает сервис из реестра, возвращает [(chat_id, message_id)]"""
+        entry = self._entries.pop(str(sid), None)
+        if not entry:
+            return []
+        self._dirty = True
+        return [(int(c), m[0]) for c, m in entry['chats'].items()]
+
+
+message_registry = MessageRegistry(MESSAGES_FILE)
+
+
+def _not_modified(error):
+    return isinstance(error, BadRequest) and "not modified" in str(error).lower()
+
+
+async def deliver_reminder(chat_id, service, text, markup, notification_type):
+    """Правит прошлое напоминание в чате или шлёт новое и снимает кнопки со старого"""
+    sid = service.id
+    priority = SEND_PRIORITY.get(notification_type, PRIORITY_DEFAULT)
+    previous = message_registry.get(sid, chat_id)
+    if previous and previous[1] == notification_type and notification_type in EDIT_IN_PLACE_TYPES:
+        try:
+            await bot_call(
+                'edit_message_text', priority, chat_id=chat_id, message_id=previous[0],
+                text=text, reply_markup=markup, parse_mode='HTML'
+            )
+            message_registry.record(sid, chat_id, previous[0], notification_type)
+            return previous[0]
+        except SendDropped:
+            raise
+        except Exception as e:
+            if _not_modified(e):
+                return previous[0]
+            logger.info(f"Не удалось править напоминание {previous[0]} — отправляю новое: {e}")
+
+    message = await send_to_chat(chat_id, text, priority, reply_markup=markup, parse_mode='HTML')
+    if previous:
+        try:
+            await bot_call(
+                'edit_message_reply_markup', PRIORITY_DEFAULT + 1,
+                chat_id=chat_id, message_id=previous[0], reply_markup=None
+            )
+        except Exception as e:
+            logger.debug(f"Не удалось снять кнопки со старого напоминания: {e}")
+    message_registry.record(sid, chat_id, message.message_id, notification_type)
+    return message.message_id
+
+
+async def settle_service_messages(sids, text=None, skip=None):
+    """После смены статуса приводит напоминания в остальных чатах к новому
+    состоянию: заменяет текст (или только снимает кнопки) и забывает их"""
+    calls = []
+    for sid in sids:
+        for chat_id, message_id in message_registry.forget(sid):
+            if skip == (chat_id, message_id):
+                continue
+            if text:
+                calls.append(bot_call(
+                    'edit_message_text', chat_id=chat_id, message_id=message_id,
+                    text=text, parse_mode='HTML'
+                ))
+            else:
+                calls.append(bot_call(
+                    'edit_message_reply_markup', chat_id=chat_id, message_id=message_id, reply_markup=None
+                ))
+    if calls:
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception) and not _not_modified(r)]
+        if failed:
+            logger.debug(f"Не удалось обновить {len(failed)} напоминаний: {failed[0]}")
+    message_registry.save()
+
 
 # ===== Уведомления о жизненном цикле бота =====
-async def send_bot_start_notification():
+async def run_startup_checks():
+    """Отчёт о запуске и проверка истекающих — параллельно, из одного снимка"""
+    try:
+        snapshot = await asyncio.to_thread(get_snapshot, 0)
+    except Exception as e:
+        logger.error(f"Ошибка получения снимка при запуске: {e}")
+        snapshot = None
+    await asyncio.gather(
+        send_bot_start_notification(snapshot),
+        check_expiring_projects_on_startup(snapshot)
+    )
+
+
+async def send_bot_start_notification(snapshot):
     """Отправляет уведомление о запуске бота"""
-    global bot_start_time
-    if ADMIN_ID == 0:
+    if not BROADCAST_CHATS:
         return
 
     try:
-        bot_start_time = get_current_datetime()
-
         try:
-            services = db_fetch_all_services()
-            total = len(services)
-            active = len([s for s in services if s.get('status') == 'active'])
-            notified = len([s for s in services if s.get('status') == 'notified'])
-            paid = len([s for s in services if s.get('status') == 'paid'])
-            users = len(set(s.get('user_id') for s in services if s.get('user_id')))
-            cost = sum(float(s.get('cost', 0)) for s in services if s.get('status') == 'active' and s.get('cost'))
+            if snapshot is None:
+                raise RuntimeError("снимок сервисов недоступен")
+            counts = snapshot.status_counts()
+            total = len(snapshot)
+            active = counts.get('active', 0)
+            notified = counts.get('notified', 0)
+            paid = counts.get('paid', 0)
+            users = len(set(s.user_id for s in snapshot.rows if s.user_id))
+            cost = snapshot.costs.total
         except Exception as e:
             logger.error(f"Ошибка получения статистики: {e}")
             total = active = notified = paid = users = 0
@@ -325,37 +1705,25 @@ async def send_bot_start_notification():
             msg += f"💰 Стоимость активных: {cost:,.2f} ₽\n"
         msg += "\nБот готов к работе! 🎉"
 
-        if bot_application:
-            await bot_application.bot.send_message(chat_id=ADMIN_ID, text=msg, parse_mode='HTML')
+        await broadcast(msg, parse_mode='HTML')
         logger.info("Уведомление о запуске отправлено")
-
-        await check_expiring_projects_on_startup()
     except Exception as e:
         logger.error(f"Ошибка уведомления о запуске: {e}")
 
 
-async def check_expiring_projects_on_startup():
+async def check_expiring_projects_on_startup(snapshot):
     """Проверяет истекающие сервисы при запуске"""
-    if ADMIN_ID == 0:
+    if not BROADCAST_CHATS or snapshot is None:
         return
 
     try:
-        active_services = db_fetch_active_services()
-        if not active_services:
+        if not snapshot.status_counts().get('active'):
             logger.info("Нет активных сервисов")
             return
 
-        today = get_current_date()
-        expiring = []
-        expired = []
-
-        for s in active_services:
-            exp_date = parse_db_date(s.get('expires_at', ''))
-            if not exp_date:
-                continue
-            days = (exp_date - today).days
-            if days <= 30:
-                (expired if days < 0 else expiring).append((s, days))
+        buckets = snapshot.classify(get_current_date())
+        expired = [(s, days) for s, _, days, _ in buckets['expired']]
+        expiring = [(s, days) for s, _, days, _ in buckets['expiring']]
 
         if expiring or expired:
             await send_startup_expiry_notification(expiring, expired)
@@ -373,9 +1741,9 @@ async def send_startup_expiry_notification(expiring, expired):
         if expired:
             msg += f"❌ <b>УЖЕ ИСТЕКЛИ ({len(expired)}):</b>\n"
             for s, days in sorted(expired, key=lambda x: x[1])[:10]:
-                cost = f" ({esc(s.get('cost'))} ₽)" if s.get('cost') else ""
-                project = f" [{esc(s.get('project'))}]" if s.get('project') else ""
-                msg += f"• {esc(s.get('name', '?'))}{project}{cost} — {abs(days)} дн. назад\n"
+                cost = f" ({esc(s.cost)} ₽)" if s.cost else ""
+                project = f" [{esc(s.project)}]" if s.project else ""
+                msg += f"• {esc(s.name or '?')}{project}{cost} — {abs(days)} дн. назад\n"
             if len(expired) > 10:
                 msg += f"... и ещё {len(expired) - 10}\n"
             msg += "\n"
@@ -383,17 +1751,16 @@ async def send_startup_expiry_notification(expiring, expired):
         if expiring:
             msg += f"⚠️ <b>СКОРО ИСТЕКУТ ({len(expiring)}):</b>\n"
             for s, days in sorted(expiring, key=lambda x: x[1])[:10]:
-                cost = f" ({esc(s.get('cost'))} ₽)" if s.get('cost') else ""
-                project = f" [{esc(s.get('project'))}]" if s.get('project') else ""
-                msg += f"• {esc(s.get('name', '?'))}{project}{cost} — через {days} дн.\n"
+                cost = f" ({esc(s.cost)} ₽)" if s.cost else ""
+                project = f" [{esc(s.project)}]" if s.project else ""
+                msg += f"• {esc(s.name or '?')}{project}{cost} — через {days} дн.\n"
             if len(expiring) > 10:
                 msg += f"... и ещё {len(expiring) - 10}\n"
             msg += "\n"
 
         msg += f"📊 Итого: {len(expired)} истекших, {len(expiring)} скоро"
 
-        if bot_application:
-            await bot_application.bot.send_message(chat_id=ADMIN_ID, text=msg, parse_mode='HTML')
+        await broadcast(msg, parse_mode='HTML')
         logger.info(f"Startup: {len(expired)} истекших, {len(expiring)} скоро")
     except Exception as e:
         logger.error(f"Ошибка startup notification: {e}")
@@ -401,7 +1768,7 @@ async def send_startup_expiry_notification(expiring, expired):
 
 async def send_bot_stop_notification():
     """Уведомление об остановке"""
-    if ADMIN_ID == 0 or bot_start_time is None:
+    if not BROADCAST_CHATS or bot_start_time is None:
         return
     try:
         stop = get_current_datetime()
@@ -417,256 +1784,782 @@ async def send_bot_stop_notification():
             f"📈 Проверок: {total_checks} | Уведомлений: {total_notifications}\n\n"
             f"До свидания! 👋"
         )
-        if bot_application:
-            await bot_application.bot.send_message(chat_id=ADMIN_ID, text=msg, parse_mode='HTML')
+        await broadcast(msg, parse_mode='HTML')
     except Exception as e:
         logger.error(f"Ошибка stop notification: {e}")
 
 
-# ===== Система уведомлений =====
-async def check_and_send_notifications():
-    """Проверяет сервисы и отправляет уведомления"""
-    if ADMIN_ID == 0:
-        return
+# ===== История прогонов =====
+HISTORY_FILE = os.path.join(DATA_DIR, 'history.sqlite')
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "180"))
+HISTORY_DEFAULT_DAYS = 7
 
-    try:
-        update_statistics(checks_increment=1)
-        services = db_fetch_active_services()
-        if not services:
-            return
 
-        today = get_current_date()
-        sent = 0
+class RunHistory:
+    """Журнал прогонов планировщика в SQLite: одна строка на прогон.
 
-        for service in services:
-            exp_date = parse_db_date(service.get('expires_at', ''))
-            if not exp_date:
-                continue
+    Старше HISTORY_RETENTION_DAYS удаляется при каждой записи. Соединение
+    открывается на операцию — журнал пишут и читают из разных потоков.
+    """
 
-            days = (exp_date - today).days
-            notification_type = None
-
-            if days == 30:
-                notification_type = "month"
-            elif days == 14:
-                notification_type = "two_weeks"
-            elif days == 7:
-                notification_type = "one_week"
-            elif 1 <= days <= 5:
-                notification_type = "daily"
-            elif days <= 0:
-                notification_type = "expired"
-
-            if notification_type:
-                # Не дублировать уведомления за тот же день
-                last = parse_db_date(service.get('notification_date'))
-                if last and last == today:
-                    continue
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS runs ("
+        "started_at TEXT NOT NULL, kind TEXT NOT NULL, duration_ms REAL, rows INTEGER, "
+        "sent INTEGER, deferred INTEGER, by_type TEXT, db_errors INTEGER, send_errors INTEGER, "
+        "retries INTEGER, complete INTEGER)"
+    )
 
-                await send_service_notification(service, notification_type, days)
-                sent += 1
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute(self.SCHEMA)
+        conn.execute("CREATE INDEX IF NOT EXISTS runs_started ON runs (started_at)")
+        return conn
+
+    def record(self, run):
+        cutoff = (get_current_datetime() - timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+        with contextlib.closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO runs VALUES (:started_at, :kind, :duration_ms, :rows, :sent, :deferred, "
+                ":by_type, :db_errors, :send_errors, :retries, :complete)",
+                dict(run, by_type=json.dumps(run['by_type']))
+            )
+            conn.execute("DELETE FROM runs WHERE started_at < ?", (cutoff,))
+
+    def runs(self, days):
+        """Прогоны за последние days дней, по времени"""
+        since = (get_current_date() - timedelta(days=days - 1)).isoformat()
+        with contextlib.closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM runs WHERE started_at >= ? ORDER BY started_at", (since,)
+            ).fetchall()
+        return [dict(r, by_type=json.loads(r['by_type'] or '{}')) for r in rows]
+
+
+run_history = RunHistory(HISTORY_FILE)
+
+
+def begin_run():
+    with _run_counters_lock:
+        counters = dict(run_counters)
+    return {'started_at': get_current_datetime_iso(), 'monotonic': time.monotonic(), 'counters': counters}
+
+
+async def end_run(run, kind, rows=0, sent=0, deferred=0, by_type=None, complete=True):
+    """Пишет прогон в историю; ошибки журнала не мешают работе"""
+    with _run_counters_lock:
+        delta = {k: run_counters[k] - run['counters'].get(k, 0) for k in run_counters}
+    record = {
+        'started_at': run['started_at'],
+        'kind': kind,
+        'duration_ms': round((time.monotonic() - run['monotonic']) * 1000, 1),
+        'rows': rows,
+        'sent': sent,
+        'deferred': deferred,
+        'by_type': dict(by_type or {}),
+        'db_errors': delta.get('db_errors', 0),
+        'send_errors': delta.get('send_errors', 0),
+        'retries': delta.get('db_retries', 0) + delta.get('send_retries', 0),
+        'complete': int(bool(complete)),
+    }
+    try:
+        await asyncio.to_thread(run_history.record, record)
+    except Exception as e:
+        logger.warning(f"Не удалось записать историю прогона: {e}")
 
-                try:
-                    db_update_service(service['id'], {
-                        "notification_date": today.isoformat(),
-                        "last_notification": notification_type
-                    })
-                except Exception as e:
-                    logger.error(f"Ошибка обновления notification_date: {e}")
 
-        if sent > 0:
-            update_statistics(notifications_increment=sent)
-            logger.info(f"Отправлено {sent} уведомлений")
-    except Exception as e:
-        logger.error(f"Ошибка check_and_send_notifications: {e}")
+# ===== Система уведомлений =====
+DEFERRED_FILE = os.path.join(DATA_DIR, 'deferred.json')
+DEFERRED_MAX_DAYS = 3  # отложенное дольше — уже неактуально
+DEFERRED_RETRY_INTERVAL = 600  # секунд между попытками отправить отложенное
 
 
-async def send_service_notification(service, notification_type, days_left):
-    """Отправляет уведомление о конкретном сервисе"""
-    try:
-        headers = {
-            "month": "📅 <b>За месяц</b>",
-            "two_weeks": "⚠️ <b>За 2 недели</b>",
-            "one_week": "🚨 <b>За неделю</b>",
-            "daily": "🔥 <b>Срочно!</b>",
-            "expired": "💀 <b>ИСТЁК!</b>",
-        }
+def notification_type_for(days):
+    """Тип уведомления для числа дней до окончания (или None)"""
+    if days == 30:
+        return "month"
+    if days == 14:
+        return "two_weeks"
+    if days == 7:
+        return "one_week"
+    if 1 <= days <= 5:
+        return "daily"
+    if days <= 0:
+        return "expired"
+    return None
 
-        msg = f"{headers.get(notification_type, '🔔')}\n\n"
-        msg += f"📋 <b>Сервис:</b> {esc(service['name'])}\n"
-        msg += f"📅 <b>Окончание:</b> {esc(service.get('expires_at', '?'))}\n"
 
-        if days_left > 0:
-            msg += f"⏰ <b>Осталось:</b> {days_left} дн.\n"
-        elif days_left == 0:
-            msg += f"⏰ <b>Истекает сегодня!</b>\n"
-        else:
-            msg += f"⏰ <b>Просрочено:</b> {abs(days_left)} дн.\n"
-
-        if service.get('project'):
-            msg += f"🏢 <b>Проект:</b> {esc(service['project'])}\n"
-        if service.get('provider'):
-            msg += f"🌐 <b>Провайдер:</b> {esc(service['provider'])}\n"
-        if service.get('cost'):
-            msg += f"💰 <b>Стоимость:</b> {esc(service['cost'])} ₽\n"
-
-        # Кнопки
-        sid = service['id']
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Оплачено", callback_data=f"paid:{sid}"),
-                InlineKeyboardButton("🔔 Уведомил", callback_data=f"notified:{sid}:{notification_type}")
-            ],
-            [
-                InlineKeyboardButton("📅 Продли на год", callback_data=f"extend:{sid}:365"),
-                InlineKeyboardButton("📅 +3 мес", callback_data=f"extend:{sid}:90")
-            ]
-        ]
+class DeferredReminders:
+    """Заблаговременные уведомления, отложенные из-за давления на отправку.
 
-        if bot_application:
-            await bot_application.bot.send_message(
-                chat_id=ADMIN_ID, text=msg,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='HTML'
-            )
-        logger.info(f"Уведомление: {service['name']} ({notification_type})")
-    except Exception as e:
-        logger.error(f"Ошибка уведомления {service.get('name', '?')}: {e}")
+    {str(id): {'type', 'date'}} в data/, чтобы отложенное пережило перезапуск.
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
 
-# ===== Обработчики callback-кнопок =====
-async def handle_all_callbacks(update: Update, context: CallbackContext):
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    self._entries = json.load(f)
+                if self._entries:
+                    logger.info(f"Отложенных уведомлений: {len(self._entries)}")
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить отложенные уведомления: {e}")
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить отложенные уведомления: {e}")
+
+    def add(self, sid, notification_type, today):
+        self._entries.setdefault(str(sid), {'type': notification_type, 'date': today.isoformat()})
+
+    def discard(self, sid):
+        self._entries.pop(str(sid), None)
+
+    def due(self, today):
+        """[(id, тип)] актуальных записей"""
+        cutoff = (today - timedelta(days=DEFERRED_MAX_DAYS)).isoformat()
+        return [(sid, v['type']) for sid, v in self._entries.items() if v['date'] >= cutoff]
+
+    def stale(self, today):
+        """[(id, тип, дата)] отложенных дольше DEFERRED_MAX_DAYS — их уже не отправить"""
+        cutoff = (today - timedelta(days=DEFERRED_MAX_DAYS)).isoformat()
+        return [(sid, v['type'], v['date']) for sid, v in self._entries.items() if v['date'] < cutoff]
+
+
+deferred_reminders = DeferredReminders(DEFERRED_FILE)
+
+
+def plan_notifications(services, today):
+    """Решение ежедневной проверки: [(приоритет, дней, сервис, тип)],
+    сначала срочные. Уже уведомлённые сегодня пропускаются."""
+    due = []
+    for service in services:
+        days = service.days_left(today)
+        if days is None:
+            continue
+        notification_type = notification_type_for(days)
+        if notification_type and service.notification_date != today:
+            due.append((SEND_PRIORITY[notification_type], days, service, notification_type))
+    due.sort(key=lambda x: (x[0], x[1]))
+    return due
+
+
+def notification_write(notification_type, today):
+    """Что записывается в БД после успешной отправки"""
+    return {
+        "notification_date": today.isoformat(),
+        "last_notification": notification_type
+    }
+
+
+# Кому уже ушло уведомление: поток изменений может принести строку
+# раньше, чем в ней окажется записанный notification_date
+notified_today = {}
+
+
+async def notify_and_mark(service, notification_type, days, today):
+    """Отправка и отметка в БД — одна операция: drain дождётся обеих"""
+    key = str(service.id)
+    if notified_today.get(key) == today:
+        return False
+    notified_today[key] = today
+    batch = send_batch.set(SimpleNamespace(started=False))
+    async with inflight:
+        try:
+            sent = await send_service_notification(service, notification_type, days)
+        finally:
+            send_batch.reset(batch)
+        if not sent:
+            notified_today.pop(key, None)
+            return False
+        try:
+            await asyncio.to_thread(db_update_service, service.id, notification_write(notification_type, today))
+        except Exception as e:
+            logger.error(f"Ошибка обновления notification_date: {e}")
+        return True
+
+
+# Сколько уведомлений одновременно в работе: хватает, чтобы хвост очереди
+# отправки дорос до SEND_BACKLOG_LIMIT и сработало откладывание. В DRAIN_TIMEOUT
+# это не укладывается, поэтому при остановке не начатые снимаются с очереди
+NOTIFY_PIPELINE = max(SEND_CONCURRENCY, int(SEND_RATE * SEND_BACKLOG_LIMIT * 2))
+
+
+async def send_planned(due, today):
+    """Отправляет план из plan_notifications конвейером.
+
+    Уведомления запускаются по приоритету, до NOTIFY_PIPELINE одновременно:
+    очередь отправки сама выдаёт срочное первым, а заблаговременные при
+    давлении откладываются в deferred_reminders. При остановке начатые
+    напоминания доводятся до конца вместе с отметкой, а ещё не начатые
+    снимаются с очереди целиком и уйдут после запуска.
+    Возвращает (Counter отправленных по типам, отложено, обработан ли весь план).
+    """
+    sent = Counter()
+    deferred = 0
+    complete = True
+    slots = asyncio.Semaphore(NOTIFY_PIPELINE)
+    tasks = set()
+
+    async def notify(service, notification_type, days):
+        try:
+            if await notify_and_mark(service, notification_type, days, today):
+                deferred_reminders.discard(service.id)
+                sent[notification_type] += 1
+        finally:
+            slots.release()
+
+    for priority, days, service, notification_type in due:
+        if stop_requested:
+            complete = False
+            break
+        await slots.acquire()
+        if priority >= DEFERRABLE_PRIORITY and send_pressure():
+            slots.release()
+            deferred_reminders.add(service.id, notification_type, today)
+            deferred += 1
+            continue
+        task = asyncio.create_task(notify(service, notification_type, days))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка отправки уведомления: {result}")
+    # Снятые при остановке напоминания не отмечены — прогон не завершён
+    return sent, deferred, complete and not stop_requested
+
+
+async def check_and_send_notifications():
+    """Проверяет сервисы и отправляет уведомления.
+
+    Срочные уходят первыми (SEND_PRIORITY), заблаговременные при давлении
+    на отправку откладываются в deferred_reminders.
+    Возвращает True, если все сервисы обработаны (прогон можно считать
+    завершённым), False — при ошибке или прерывании остановкой.
+    """
+    if not BROADCAST_CHATS:
+        return True
+
+    if traffic_recorder is not None:
+        traffic_recorder.record('job', name='check')
+    started = time.monotonic()
+    run = begin_run()
+    services = []
+    sent = deferred = 0
+    by_type = Counter()
+    complete = True
+    try:
+        update_statistics(checks_increment=1)
+        services = Service.from_rows(await asyncio.to_thread(db_fetch_active_services))
+        if not services:
+            return True
+
+        today = get_current_date()
+
+        by_type, deferred, complete = await send_planned(plan_notifications(services, today), today)
+        sent = sum(by_type.values())
+        if not complete:
+            logger.warning("Проверка прервана остановкой бота — оставшиеся сервисы будут проверены после запуска")
+
+        callback_tokens.save()
+        message_registry.save()
+        deferred_reminders.save()
+        if sent > 0:
+            update_statistics(notifications_increment=sent)
+        logger.info(f"Отправлено {sent} уведомлений, отложено {deferred}", extra={
+            'rows': len(services),
+            'sent': sent,
+            'deferred': deferred,
+            'duration_ms': round((time.monotonic() - started) * 1000, 1),
+        })
+        return complete
+    except Exception as e:
+        logger.error(f"Ошибка check_and_send_notifications: {e}")
+        complete = False
+        return False
+    finally:
+        await end_run(run, 'check', len(services), sent, deferred, by_type, complete)
+
+
+async def flush_deferred_reminders():
+    """Отправляет отложенные уведомления, пока нет давления на отправку"""
+    if not len(deferred_reminders) or not BROADCAST_CHATS or send_pressure():
+        return 0
+    today = get_current_date()
+    run = begin_run()
+    snapshot = await asyncio.to_thread(get_snapshot, 0)
+    by_id = {str(s.id): s for s in snapshot.rows}
+    stale = deferred_reminders.stale(today)
+    if stale:
+        await report_stale_deferred(stale, by_id)
+    sent = 0
+    by_type = Counter()
+    due = deferred_reminders.due(today)
+    for sid, notification_type in due:
+        if stop_requested or send_pressure():
+            break
+        service = by_id.get(sid)
+        if service is None or service.status != 'active' or service.notification_date == today or not service.expires:
+            deferred_reminders.discard(sid)
+            continue
+        if await notify_and_mark(service, notification_type, service.days_left(today), today):
+            deferred_reminders.discard(sid)
+            sent += 1
+            by_type[notification_type] += 1
+    deferred_reminders.save()
+    message_registry.save()
+    callback_tokens.save()
+    if sent:
+        update_statistics(notifications_increment=sent)
+        logger.info(f"Отправлено отложенных уведомлений: {sent}, осталось {len(deferred_reminders)}")
+    await end_run(run, 'deferred', len(due), sent, len(deferred_reminders), by_type)
+    return sent
+
+
+async def report_stale_deferred(stale, by_id):
+    """Сводка отложенных напоминаний, которые так и не ушли: молча их не теряем.
+
+    Записи удаляются, только когда сводку получил хоть один получатель.
+    """
+    labels = {"month": "за месяц", "two_weeks": "за 2 недели", "one_week": "за неделю"}
+    logger.warning(f"Отложенные напоминания устарели: {len(stale)}")
+    msg = (
+        f"📭 <b>Не отправленные напоминания</b>\n"
+        f"Откладывались дольше {DEFERRED_MAX_DAYS} дн. из-за ограничений Telegram\n\n"
+    )
+    for sid, notification_type, since in stale:
+        service = by_id.get(sid)
+        name = esc(service.name or '?') if service else f"#{sid}"
+        msg += f"• {name} — {labels.get(notification_type, notification_type)}, с {date.fromisoformat(since).strftime('%d.%m')}\n"
+    for part in split_message(msg):
+        if not await broadcast(part, parse_mode='HTML'):
+            return
+    for sid, _, _ in stale:
+        deferred_reminders.discard(sid)
+
+
+NOTIFICATION_HEADERS = {
+    "month": "📅 <b>За месяц</b>",
+    "two_weeks": "⚠️ <b>За 2 недели</b>",
+    "one_week": "🚨 <b>За неделю</b>",
+    "daily": "🔥 <b>Срочно!</b>",
+    "expired": "💀 <b>ИСТЁК!</b>",
+}
+
+
+def format_service_card(service, header, days_left):
+    """Карточка сервиса: заголовок, срок, проект, провайдер, стоимость"""
+    msg = f"{header}\n\n"
+    msg += f"📋 <b>Сервис:</b> {esc(service.name)}\n"
+    msg += f"📅 <b>Окончание:</b> {esc(service.expires_at or '?')}\n"
+
+    if days_left is None:
+        pass
+    elif days_left > 0:
+        msg += f"⏰ <b>Осталось:</b> {days_left} дн.\n"
+    elif days_left == 0:
+        msg += f"⏰ <b>Истекает сегодня!</b>\n"
+    else:
+        msg += f"⏰ <b>Просрочено:</b> {abs(days_left)} дн.\n"
+
+    if service.project:
+        msg += f"🏢 <b>Проект:</b> {esc(service.project)}\n"
+    if service.provider:
+        msg += f"🌐 <b>Провайдер:</b> {esc(service.provider)}\n"
+    if service.cost:
+        msg += f"💰 <b>Стоимость:</b> {esc(service.cost)} ₽\n"
+    return msg
+
+
+def _date_tag(value):
+    """Дата окончания для callback_data: 'YYYYMMDD' или '-'"""
+    return value.strftime('%Y%m%d') if value else '-'
+
+
+def service_keyboard(service, notification_type="manual"):
+    """Кнопки действий с сервисом: оплачено / уведомил / продлить"""
+    ref = service_ref(service)
+    seen = _date_tag(service.expires)
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Оплачено", callback_data=f"paid:{ref}"),
+            InlineKeyboardButton("🔔 Уведомил", callback_data=f"notified:{ref}:{notification_type}")
+        ],
+        [
+            InlineKeyboardButton("📅 Продли на год", callback_data=f"extend:{ref}:365:{seen}"),
+            InlineKeyboardButton("📅 +3 мес", callback_data=f"extend:{ref}:90:{seen}")
+        ]
+    ])
+
+
+async def send_service_notification(service, notification_type, days_left):
+    """Отправляет уведомление о конкретном сервисе, возвращает True при успехе"""
+    started = time.monotonic()
+    try:
+        msg = format_service_card(service, NOTIFICATION_HEADERS.get(notification_type, '🔔'), days_left)
+        markup = service_keyboard(service, notification_type)
+
+        delivered = await fan_out(
+            lambda chat_id: deliver_reminder(chat_id, service, msg, markup, notification_type)
+        )
+        if BROADCAST_CHATS and not delivered:
+            raise RuntimeError("не доставлено ни одному получателю")
+        logger.info(f"Уведомление: {service.name} ({notification_type})", extra={
+            'service_id': service.id,
+            'notification_type': notification_type,
+            'duration_ms': round((time.monotonic() - started) * 1000, 1),
+        })
+        return True
+    except SendDropped:
+        logger.info(f"Уведомление {service.name or '?'} снято при остановке — уйдёт после запуска")
+        return False
+    except Exception as e:
+        logger.error(f"Ошибка уведомления {service.name or '?'}: {e}", extra={
+            'service_id': service.id,
+            'notification_type': notification_type,
+        })
+        return False
+
+
+# ===== Массовые операции =====
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "100"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+BULK_PROGRESS_INTERVAL = 1.5  # секунд между правками сообщения
+HOSTING_CATEGORIES = ('hosting', 'domain')
+
+
+async def _edit_quietly(query, text, **kwargs):
+    """edit_message_text без падения на 'message is not modified' и т.п."""
+    try:
+        await query.edit_message_text(text, parse_mode='HTML', **kwargs)
+    except Exception as e:
+        logger.debug(f"Не удалось обновить сообщение: {e}")
+
+
+async def run_bulk_update(query, title, ids, data, details=""):
+    """Массовое обновление сервисов с прогрессом в сообщении.
+
+    ID режутся на чанки по BULK_CHUNK_SIZE (чтобы не упереться в длину URL
+    PostgREST), чанки выполняются в потоках не более BULK_CONCURRENCY
+    одновременно. Неудавшиеся чанки не прерывают остальные: в итоговом
+    сообщении появляется кнопка повтора только для них.
+    """
+    total = len(ids)
+    chunks = [ids[i:i + BULK_CHUNK_SIZE] for i in range(0, total, BULK_CHUNK_SIZE)]
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    progress = {'done': 0, 'last_edit': 0.0}
+    failed = []
+
+    async def report_progress():
+        now = time.monotonic()
+        if now - progress['last_edit'] < BULK_PROGRESS_INTERVAL:
+            return
+        progress['last_edit'] = now
+        await _edit_quietly(query, f"⏳ {title}\n\n📊 {progress['done']}/{total}")
+
+    async def run_chunk(chunk):
+        async with semaphore:
+            try:
+                await asyncio.to_thread(db_bulk_update_services, chunk, data)
+            except Exception as e:
+                logger.error(f"Массовое обновление: чанк из {len(chunk)} не выполнен: {e}")
+                failed.extend(chunk)
+            progress['done'] += len(chunk)
+            await report_progress()
+
+    started = time.monotonic()
+    await asyncio.gather(*(run_chunk(c) for c in chunks))
+    logger.info(
+        f"Массовое обновление: {total - len(failed)}/{total} за {time.monotonic() - started:.2f} сек "
+        f"({len(chunks)} чанков)"
+    )
+
+    msg = f"{title}\n\n📊 Обновлено: {total - len(failed)} из {total}"
+    if details:
+        msg += f"\n{details}"
+    markup = None
+    if failed:
+        msg += f"\n⚠️ Не удалось: {len(failed)}"
+        token = callback_tokens.token_for(
+            'bulk', f"{time.time_ns()}", title=title, ids=failed, data=data, details=details
+        )
+        callback_tokens.save()
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Повторить", callback_data="@" + token)]])
+    await _edit_quietly(query, msg, reply_markup=markup)
+    # Старые напоминания по обновлённым сервисам больше не актуальны — снимаем кнопки
+    failed_set = set(failed)
+    await settle_service_messages([sid for sid in ids if sid not in failed_set])
+    return failed
+
+
+# ===== Обработчики callback-кнопок =====
+class KeyedLocks:
+    """asyncio.Lock на ключ; лок удаляется, как только его никто не держит и не ждёт"""
+
+    def __init__(self):
+        self._locks = {}  # ключ -> [lock, число держателей и ожидающих]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+# Чтение-изменение-запись одного сервиса выполняется под его локом
+service_locks = KeyedLocks()
+# Выполняющиеся callback'и: повторное нажатие той же кнопки не запускает вторую операцию
+pending_callbacks = set()
+
+
+def _callback_key(query):
+    """Ключ склейки: изменяющие кнопки — по данным (одна операция на сервис),
+    кнопки просмотра — ещё и по сообщению, чтобы не глотать чужие нажатия"""
+    if _is_read_only_callback(query.data):
+        return (query.data, _query_message_key(query))
+    return query.data
+
+
+async def handle_all_callbacks(update: Update, context: CallbackContext):
     """Маршрутизатор всех callback запросов"""
     query = update.callback_query
     if not query or not query.data:
         return
 
+    user_id = query.from_user.id if query.from_user else None
+    if not has_role(user_id, 'admin') and not (has_role(user_id, 'viewer') and _is_read_only_callback(query.data)):
+        await query.answer("❌ Доступ запрещён.", show_alert=True)
+        return
+
+    key = _callback_key(query)
+    if key in pending_callbacks:
+        await query.answer("⏳ Уже выполняется…")
+        return
+
+    token = _callback_token(query.data)
+    if token is not None and callback_tokens.resolve(token) is None:
+        # Сообщение не трогаем: текст напоминания остаётся на месте
+        await query.answer("⌛ Кнопка устарела — откройте список заново.", show_alert=True)
+        return
+
+    pending_callbacks.add(key)
     try:
         await query.answer()
         data = query.data
 
-        if data.startswith("paid:"):
-            await _handle_paid(query, data)
-        elif data.startswith("notified:"):
-            await _handle_notified(query, data)
-        elif data.startswith("extend:"):
-            await _handle_extend(query, data)
-        elif data == "all_paid_startup":
-            await _handle_all_paid(query)
-        elif data == "extend_all_hosting_startup":
-            await _handle_extend_all_hosting(query)
-        elif data.startswith("select_project:"):
-            await _handle_select_project(query, data)
-        elif data.startswith("select_provider:"):
-            await _handle_select_provider(query, data)
-        else:
-            logger.warning(f"Неизвестный callback: {data}")
-
+        async with inflight:
+            await _route_callback(query, data)
     except Exception as e:
         logger.error(f"Ошибка callback '{query.data}': {e}")
         try:
             await query.edit_message_text(f"❌ Ошибка: {str(e)}")
         except Exception:
             pass
+    finally:
+        pending_callbacks.discard(key)
+
+
+READ_ONLY_TOKEN_KINDS = ('project', 'provider', 'page')
+
+
+def _callback_token(data):
+    """Токен реестра в callback_data: '@tok' или 'действие:@tok:...' (иначе None)"""
+    if data.startswith("@"):
+        return data[1:]
+    parts = data.split(":", 2)
+    if len(parts) > 1 and parts[1].startswith("@"):
+        return parts[1][1:]
+    return None
+
+
+def _is_read_only_callback(data):
+    """Кнопки просмотра, доступные роли viewer"""
+    if data.startswith(("select_project:", "select_provider:")):
+        return True
+    if data.startswith("@"):
+        entity = callback_tokens.resolve(data[1:])
+        return entity is not None and entity['kind'] in READ_ONLY_TOKEN_KINDS
+    return False
+
+
+async def _route_callback(query, data):
+    """Выбор обработчика по префиксу callback_data"""
+    if data.startswith("paid:"):
+        await _handle_paid(query, data)
+    elif data.startswith("notified:"):
+        await _handle_notified(query, data)
+    elif data.startswith("extend:"):
+        await _handle_extend(query, data)
+    elif data == "all_paid_startup":
+        await _handle_all_paid(query)
+    elif data == "extend_all_hosting_startup":
+        await _handle_extend_all_hosting(query)
+    elif data.startswith("@"):
+        await _handle_token(query, data[1:])
+    elif data.startswith("select_project:"):
+        await _handle_select_project(query, data.split(":", 1)[1])
+    elif data.startswith("select_provider:"):
+        await _handle_select_provider(query, data.split(":", 1)[1])
+    else:
+        logger.warning(f"Неизвестный callback: {data}")
+
+
+async def _handle_token(query, token):
+    """Кнопка с токеном из реестра: проект, провайдер или страница списка"""
+    entity = callback_tokens.resolve(token)
+    if entity is None:
+        # Проверено в handle_all_callbacks; сюда попадаем только при гонке с вытеснением
+        logger.warning(f"Токен вытеснен во время обработки: {token}")
+        return
+    kind = entity['kind']
+    if kind == 'project':
+        await _handle_select_project(query, entity['key'])
+    elif kind == 'provider':
+        await _handle_select_provider(query, entity['key'])
+    elif kind == 'bulk':
+        await run_bulk_update(query, entity['title'], entity['ids'], entity['data'], entity.get('details', ""))
+    elif kind == 'page':
+        facets = (await asyncio.to_thread(get_snapshot)).facets(entity['field'])
+        await query.edit_message_reply_markup(
+            reply_markup=facet_keyboard(facets, entity['field'], entity['offset'])
+        )
+    else:
+        logger.warning(f"Неизвестный тип токена: {kind}")
+
+
+def _query_message_key(query):
+    """(chat_id, message_id) сообщения, на котором нажата кнопка"""
+    message = query.message
+    return (message.chat_id, message.message_id) if message else None
 
 
 async def _handle_paid(query, data):
     """Кнопка 'Оплачено'"""
     parts = data.split(":")
-    sid = parts[1]
+    sid, name = resolve_service_ref(parts[1])
 
-    name = db_fetch_service_name(sid)
+    async with service_locks.hold(sid):
+        if name is None:
+            name = await asyncio.to_thread(db_fetch_service_name, sid)
 
-    db_update_service(sid, {
-        "status": "paid",
-        "payment_date": get_current_datetime_iso()
-    })
+        await asyncio.to_thread(db_update_service, sid, {
+            "status": "paid",
+            "payment_date": get_current_datetime_iso()
+        })
 
-    await query.edit_message_text(
-        f"💰 <b>Оплачено!</b>\n\n📋 {esc(name)}\n✅ Убран из уведомлений.",
-        parse_mode='HTML'
-    )
+    text = f"💰 <b>Оплачено!</b>\n\n📋 {esc(name)}\n✅ Убран из уведомлений."
+    await query.edit_message_text(text, parse_mode='HTML')
+    await settle_service_messages([sid], text, skip=_query_message_key(query))
 
 
 async def _handle_notified(query, data):
     """Кнопка 'Уведомил'"""
     parts = data.split(":")
-    sid = parts[1]
+    sid, name = resolve_service_ref(parts[1])
     ntype = parts[2] if len(parts) > 2 else "manual"
 
-    name = db_fetch_service_name(sid)
+    async with service_locks.hold(sid):
+        if name is None:
+            name = await asyncio.to_thread(db_fetch_service_name, sid)
 
-    db_update_service(sid, {
-        "status": "notified",
-        "last_notification": ntype,
-        "notification_date": get_current_datetime_iso()
-    })
+        await asyncio.to_thread(db_update_service, sid, {
+            "status": "notified",
+            "last_notification": ntype,
+            "notification_date": get_current_datetime_iso()
+        })
 
-    await query.edit_message_text(
-        f"🔔 <b>Уведомил, жду оплаты</b>\n\n📋 {esc(name)}\n✅ Статус обновлён.",
-        parse_mode='HTML'
-    )
+    text = f"🔔 <b>Уведомил, жду оплаты</b>\n\n📋 {esc(name)}\n✅ Статус обновлён."
+    await query.edit_message_text(text, parse_mode='HTML')
+    await settle_service_messages([sid], text, skip=_query_message_key(query))
 
 
 async def _handle_extend(query, data):
     """Кнопка 'Продлить'"""
     parts = data.split(":")
-    sid = parts[1]
+    sid, _ = resolve_service_ref(parts[1])
     days = int(parts[2]) if len(parts) > 2 else 365
+    seen = parts[3] if len(parts) > 3 else None  # срок на момент показа кнопки
 
-    service = db_fetch_service(sid)
-    if not service:
-        await query.edit_message_text("❌ Сервис не найден.")
-        return
-    old_date = service.get('expires_at', '?')
-    base_date = parse_db_date(old_date)
-    if base_date and base_date > get_current_date():
-        new_date = (base_date + timedelta(days=days)).strftime("%Y-%m-%d")
-    else:
-        new_date = (get_current_datetime() + timedelta(days=days)).strftime("%Y-%m-%d")
-
-    db_update_service(sid, {
-        "expires_at": new_date,
-        "status": "active",
-        "last_notification": None,
-        "notification_date": None
-    })
+    async with service_locks.hold(sid):
+        row = await asyncio.to_thread(db_fetch_service, sid)
+        if not row:
+            await query.edit_message_text("❌ Сервис не найден.")
+            return
+        service = Service(row)
+        if seen is not None and seen != _date_tag(service.expires):
+            # Повторное нажатие или продлили из другого сообщения — второй раз не продлеваем
+            await query.edit_message_text(
+                f"ℹ️ <b>Уже продлено</b>\n\n📋 {esc(service.name)}\n📅 Срок: {esc(service.expires_at or '?')}",
+                parse_mode='HTML'
+            )
+            return
+        old_date = service.expires_at or '?'
+        base_date = service.expires
+        if base_date and base_date > get_current_date():
+            new_date = (base_date + timedelta(days=days)).strftime("%Y-%m-%d")
+        else:
+            new_date = (get_current_datetime() + timedelta(days=days)).strftime("%Y-%m-%d")
+
+        updated = await asyncio.to_thread(db_update_service_if, sid, {
+            "expires_at": new_date,
+            "status": "active",
+            "last_notification": None,
+            "notification_date": None
+        }, expires_at=service.expires_at)
+        if not updated:
+            await query.edit_message_text("⚠️ Срок сервиса изменился параллельно — откройте карточку заново.")
+            return
 
-    await query.edit_message_text(
+    text = (
         f"📅 <b>Продлено!</b>\n\n"
-        f"📋 {esc(service['name'])}\n"
+        f"📋 {esc(service.name)}\n"
         f"📅 Было: {esc(old_date)}\n"
         f"📅 Стало: {new_date}\n"
-        f"✅ Статус: активен",
-        parse_mode='HTML'
+        f"✅ Статус: активен"
     )
+    await query.edit_message_text(text, parse_mode='HTML')
+    await settle_service_messages([sid], text, skip=_query_message_key(query))
 
 
 async def _handle_all_paid(query):
     """Кнопка 'Все оплачены' (для истекающих на старте)"""
     try:
-        active = db_fetch_active_services()
-        if not active:
+        snapshot = await asyncio.to_thread(get_snapshot, 0)
+        if not snapshot.status_counts().get('active'):
             await query.edit_message_text("✅ Нет активных сервисов.")
             return
 
-        today = get_current_date()
-        ids = []
-        for s in active:
-            exp = parse_db_date(s.get('expires_at', ''))
-            if exp and (exp - today).days <= 30:
-                ids.append(s['id'])
+        buckets = snapshot.classify(get_current_date())
+        ids = [s.id for s, _, _, _ in buckets['expired'] + buckets['expiring']]
 
         if ids:
-            db_bulk_update_services(ids, {
+            await run_bulk_update(query, "💰 <b>Все оплачены!</b>", ids, {
                 "status": "paid",
                 "payment_date": get_current_datetime_iso()
             })
-
-            await query.edit_message_text(
-                f"💰 <b>Все оплачены!</b>\n\n📊 Обновлено: {len(ids)} сервисов.",
-                parse_mode='HTML'
-            )
         else:
             await query.edit_message_text("ℹ️ Нет сервисов для обновления.")
     except Exception as e:
@@ -676,100 +2569,384 @@ async def _handle_all_paid(query):
 async def _handle_extend_all_hosting(query):
     """Кнопка 'Продлить все хостинги'"""
     try:
-        active = db_fetch_active_services()
-        if not active:
+        snapshot = await asyncio.to_thread(get_snapshot, 0)
+        if not snapshot.status_counts().get('active'):
             await query.edit_message_text("✅ Нет активных сервисов.")
             return
 
-        today = get_current_date()
-        ids = []
-        for s in active:
-            exp = parse_db_date(s.get('expires_at', ''))
-            if not exp:
-                continue
-            days = (exp - today).days
-            is_hosting = (
-                'хостинг' in s.get('name', '').lower() or
-                'домен' in s.get('name', '').lower() or
-                '.' in s.get('name', '') or
-                s.get('provider', '').lower() in ['хостинг', 'хостинг-провайдер', 'доменный регистратор']
-            )
-            if days <= 30 and is_hosting:
-                ids.append(s['id'])
+        buckets = snapshot.classify(get_current_date(), categories=HOSTING_CATEGORIES)
+        ids = [s.id for s, _, _, _ in buckets['expired'] + buckets['expiring']]
 
         if ids:
             new_date = (get_current_datetime() + timedelta(days=365)).strftime("%Y-%m-%d")
-            db_bulk_update_services(ids, {
+            await run_bulk_update(query, "📅 <b>Хостинги продлены!</b>", ids, {
                 "expires_at": new_date,
                 "status": "active",
                 "last_notification": None,
                 "notification_date": None
-            })
-
-            await query.edit_message_text(
-                f"📅 <b>Хостинги продлены!</b>\n\n📊 Продлено: {len(ids)}\n📅 До: {new_date}",
-                parse_mode='HTML'
-            )
+            }, details=f"📅 До: {new_date}")
         else:
             await query.edit_message_text("ℹ️ Нет хостингов для продления.")
     except Exception as e:
         await query.edit_message_text(f"❌ Ошибка: {str(e)}")
 
 
-async def _handle_select_project(query, data):
+def render_project(snapshot, project):
+    """Сервисы проекта с итогом по стоимости"""
+    services = snapshot.select('project', project)
+    if not services:
+        return f"📭 Нет сервисов в проекте «{esc(project)}»"
+
+    msg = f"🏢 <b>Проект: {esc(project)}</b>\n\n"
+    for s in services:
+        emoji = {"active": "🟢", "paid": "🔵", "notified": "🟡"}.get(s.status, "⚪")
+        msg += f"{emoji} {esc(s.name)} — до {esc(s.expires_at or '?')}"
+        if s.cost:
+            msg += f" ({esc(s.cost)} ₽)"
+        msg += "\n"
+    total_cost = snapshot.costs.by_project.get(project, 0)
+    if total_cost > 0:
+        msg += f"\n💰 Итого активных: {total_cost:,.2f} ₽"
+    return msg
+
+
+def render_provider(snapshot, provider):
+    """Сервисы провайдера"""
+    services = snapshot.select('provider', provider)
+    if not services:
+        return f"📭 Нет сервисов у провайдера «{esc(provider)}»"
+
+    msg = f"🌐 <b>Провайдер: {esc(provider)}</b>\n\n"
+    for s in services:
+        emoji = {"active": "🟢", "paid": "🔵", "notified": "🟡"}.get(s.status, "⚪")
+        msg += f"{emoji} {esc(s.name)}"
+        if s.project:
+            msg += f" [{esc(s.project)}]"
+        msg += f" — до {esc(s.expires_at or '?')}"
+        if s.cost:
+            msg += f" ({esc(s.cost)} ₽)"
+        msg += "\n"
+    return msg
+
+
+async def _handle_select_project(query, project):
     """Показать сервисы проекта"""
-    project = data.split(":", 1)[1]
     try:
-        services = db_fetch_by_project(project)
-        if not services:
-            await query.edit_message_text(f"📭 Нет сервисов в проекте «{project}»")
-            return
-
-        msg = f"🏢 <b>Проект: {esc(project)}</b>\n\n"
-        total_cost = 0
-        for s in services:
-            emoji = {"active": "🟢", "paid": "🔵", "notified": "🟡"}.get(s.get('status'), "⚪")
-            msg += f"{emoji} {esc(s['name'])} — до {esc(s.get('expires_at', '?'))}"
-            if s.get('cost'):
-                msg += f" ({esc(s['cost'])} ₽)"
-                if s.get('status') == 'active':
-                    total_cost += float(s['cost'])
-            msg += "\n"
-        if total_cost > 0:
-            msg += f"\n💰 Итого активных: {total_cost:,.2f} ₽"
-
+        snapshot = await asyncio.to_thread(get_snapshot)
+        msg = report_cache.get(('project', project), snapshot, lambda: render_project(snapshot, project))
         await query.edit_message_text(msg, parse_mode='HTML')
     except Exception as e:
         await query.edit_message_text(f"❌ Ошибка: {str(e)}")
 
 
-async def _handle_select_provider(query, data):
+async def _handle_select_provider(query, provider):
     """Показать сервисы провайдера"""
-    provider = data.split(":", 1)[1]
     try:
-        services = db_fetch_by_provider(provider)
-        if not services:
-            await query.edit_message_text(f"📭 Нет сервисов у провайдера «{provider}»")
-            return
-
-        msg = f"🌐 <b>Провайдер: {esc(provider)}</b>\n\n"
-        for s in services:
-            emoji = {"active": "🟢", "paid": "🔵", "notified": "🟡"}.get(s.get('status'), "⚪")
-            msg += f"{emoji} {esc(s['name'])}"
-            if s.get('project'):
-                msg += f" [{esc(s['project'])}]"
-            msg += f" — до {esc(s.get('expires_at', '?'))}"
-            if s.get('cost'):
-                msg += f" ({esc(s['cost'])} ₽)"
-            msg += "\n"
-
+        snapshot = await asyncio.to_thread(get_snapshot)
+        msg = report_cache.get(('provider', provider), snapshot, lambda: render_provider(snapshot, provider))
         await query.edit_message_text(msg, parse_mode='HTML')
     except Exception as e:
         await query.edit_message_text(f"❌ Ошибка: {str(e)}")
 
 
+# ===== Экспорт =====
+EXPORT_PAGE_SIZE = 1000
+EXPORT_COLUMNS = [
+    "id", "name", "project", "provider", "category", "status", "expires_at",
+    "days_left", "cost", "notification_date", "last_notification", "payment_date",
+]
+EXPORT_FILTERS = ("project", "provider", "status", "category", "days")
+
+
+@db_query
+def db_fetch_services_page(filters, offset, limit):
+    """Страница сервисов с фильтрами, упорядоченная по id"""
+    q = get_supabase().table("digital_notificator_services").select("*")
+    for field in ("project", "provider", "status"):
+        if filters.get(field):
+            q = q.eq(field, filters[field])
+    if filters.get("days") is not None:
+        limit_date = get_current_date() + timedelta(days=filters["days"])
+        q = q.lte("expires_at", limit_date.isoformat())
+    return q.order("id").range(offset, offset + limit - 1).execute().data or []
+
+
+def iter_services(filters, page_size=EXPORT_PAGE_SIZE):
+    """Генератор сервисов постранично — в памяти одновременно одна страница"""
+    offset = 0
+    while True:
+        page = db_fetch_services_page(filters, offset, page_size)
+        yield from Service.from_rows(page)
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def iter_export_rows(filters):
+    """Строки экспорта: фильтр по категории и вычисляемые колонки"""
+    today = get_current_date()
+    wanted = filters.get("category")
+    for s in iter_services(filters):
+        category = category_classifier.classify(s.name, s.provider)
+        if wanted and category != wanted:
+            continue
+        computed = {'category': category, 'days_left': s.days_left(today)}
+        yield [computed[c] if c in computed else getattr(s, c) for c in EXPORT_COLUMNS]
+
+
+def parse_export_args(args):
+    """'/export xlsx project="Мой проект" days=30' -> (формат, фильтры)"""
+    fmt = "csv"
+    filters = {}
+    for arg in args:
+        if arg.lower() in ("csv", "xlsx"):
+            fmt = arg.lower()
+            continue
+        key, sep, value = arg.partition("=")
+        key = key.lower()
+        if not sep or key not in EXPORT_FILTERS:
+            raise ValueError(f"Неизвестный параметр: {arg}")
+        filters[key] = int(value) if key == "days" else value
+    return fmt, filters
+
+
+def write_export(fmt, filters):
+    """Пишет экспорт во временный файл построчно, возвращает (путь, число строк)"""
+    rows = 0
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=f".{fmt}")
+    try:
+        if fmt == "xlsx":
+            os.close(fd)
+            # write_only: строки сбрасываются на диск, а не копятся в памяти
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("services")
+            ws.append(EXPORT_COLUMNS)
+            for row in iter_export_rows(filters):
+                ws.append(row)
+                rows += 1
+            wb.save(path)
+        else:
+            # utf-8-sig — чтобы Excel сразу открыл кириллицу
+            with os.fdopen(fd, "w", newline="", encoding="utf-8-sig") as f:
+                writer = csv.writer(f)
+                writer.writerow(EXPORT_COLUMNS)
+                for row in iter_export_rows(filters):
+                    writer.writerow(row)
+                    rows += 1
+        return path, rows
+    except Exception:
+        os.remove(path)
+        raise
+
+
+# ===== Поиск =====
+FIND_LIMIT = 5
+INLINE_LIMIT = 20
+FIND_THRESHOLD = 0.4  # доля веса (IDF) триграмм запроса, найденных в сервисе
+FIND_MAX_CANDIDATES = 200  # сколько сервисов максимум дооцениваем на запрос
+
+# Кириллица -> латиница, чтобы «яндекс» находил «Yandex» и наоборот
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya',
+})
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize_search_text(text):
+    """Нижний регистр + транслитерация: один алфавит для поиска"""
+    return " ".join(_WORD_RE.findall(str(text or "").lower().translate(_TRANSLIT)))
+
+
+def trigrams(text):
+    """Триграммы слов с отступами как в pg_trgm: '  w', ' wo', 'wor', 'ord', 'rd '"""
+    result = set()
+    for word in text.split():
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class SearchIndex:
+    """Триграммный индекс по имени, проекту и провайдеру сервиса.
+
+    Обновляется инкрементально по снимку: переиндексируются только строки,
+    у которых изменились индексируемые поля. Опечатки и смешение алфавитов
+    гасятся транслитерацией и нечётким совпадением по триграммам.
+
+    Триграммы взвешиваются по IDF: частые («pro», « ya») почти ничего
+    не решают. Кандидаты — сервисы из самых редких списков, без которых
+    порог FIND_THRESHOLD уже не набрать; из них дооцениваются лучшие
+    FIND_MAX_CANDIDATES, так что запрос не обходит всю таблицу.
+    """
+
+    def __init__(self):
+        self._docs = {}  # id -> (исходные поля, ((нормализованный текст, триграммы) по полю))
+        self._rows = {}
+        self._postings = defaultdict(set)
+        self.version = None
+
+    def apply(self, snapshot):
+        if snapshot.version == self.version:
+            return
+        seen = set()
+        # Проекты и провайдеры повторяются: каждое значение нормализуется
+        # один раз, а его триграммы получают сразу все id (set.update)
+        fields = {}
+        pending = defaultdict(list)
+        for r in snapshot.rows:
+            sid = r.id
+            seen.add(sid)
+            self._rows[sid] = r
+            raw = (r.name, r.project, r.provider)
+            old = self._docs.get(sid)
+            if old is not None and old[0] == raw:
+                continue
+            if old is not None:
+                self._unindex(sid, old[1])
+            parts = []
+            for v in raw:
+                if not v:
+                    continue
+                part = fields.get(v)
+                if part is None:
+                    text = normalize_search_text(v)
+                    part = fields[v] = (text, frozenset(trigrams(text)))
+                parts.append(part)
+                pending[v].append(sid)
+            self._docs[sid] = (raw, tuple(parts))
+        for v, ids in pending.items():
+            for g in fields[v][1]:
+                self._postings[g].update(ids)
+        for sid in [sid for sid in self._docs if sid not in seen]:
+            self._unindex(sid, self._docs.pop(sid)[1])
+            self._rows.pop(sid, None)
+        self.version = snapshot.version
+
+    def _unindex(self, sid, parts):
+        for g in frozenset().union(*(p[1] for p in parts)):
+            ids = self._postings.get(g)
+            if ids is not None:
+                ids.discard(sid)
+                if not ids:
+                    del self._postings[g]
+
+    def search(self, query, limit=FIND_LIMIT):
+        """[(row, score)] по убыванию похожести"""
+        text = normalize_search_text(query)
+        grams = set(trigrams(text))
+        if not grams:
+            return []
+        # Последнее слово обычно недопечатано (inline-режим): его хвост 'de '
+        # совпадает только с чужими словами и не должен решать за префикс
+        if len(grams) > 1:
+            grams.discard(f"{(' ' + text.split()[-1])[-2:]} ")
+        grams = frozenset(grams)
+        n = len(self._docs) + 1
+        postings = sorted(((self._postings.get(g) or set(), g) for g in grams), key=lambda p: len(p[0]))
+        # Триграмма, которой нет в индексе, — скорее опечатка: весит как самая частая
+        weights = {g: math.log(n / (len(ids) + 1)) + 1.0 if ids else 1.0 for ids, g in postings}
+        total = sum(weights.values())
+
+        # Сервис, которого нет ни в одном из самых редких списков, набирает
+        # не больше веса остальных триграмм. Берём редкие списки, пока остаток
+        # не опустится ниже порога, и копим по ним вес попаданий каждого id.
+        rest = total
+        hits = defaultdict(float)
+        for ids, g in postings:
+            if rest < FIND_THRESHOLD * total:
+                break
+            w = weights[g]
+            rest -= w
+            for sid in ids:
+                hits[sid] += w
+        # Дооцениваем только тех, кто ещё может дотянуть до порога
+        reachable = (sid for sid, w in hits.items() if w + rest >= FIND_THRESHOLD * total)
+        candidates = heapq.nlargest(FIND_MAX_CANDIDATES, reachable, key=hits.__getitem__)
+
+        results = []
+        for sid in candidates:
+            parts = self._docs[sid][1]
+            matched = frozenset().union(*(grams & p[1] for p in parts))
+            score = sum(map(weights.__getitem__, matched)) / total
+            if text in " ".join(p[0] for p in parts):
+                score += 1.0  # точное вхождение — выше любых нечётких
+            if score >= FIND_THRESHOLD:
+                results.append((self._rows[sid], score))
+        return heapq.nsmallest(limit, results, key=lambda x: (-x[1], str(x[0].name or '')))
+
+search_index = SearchIndex()
+
+
+search_lock = threading.Lock()
+
+
+def find_services(query, limit=FIND_LIMIT):
+    """Поиск по актуальному снимку; индекс догоняет снимок при необходимости.
+
+    Вызывается из рабочих потоков, поэтому индекс защищён блокировкой.
+    """
+    with search_lock:
+        search_index.apply(get_snapshot())
+        started = time.perf_counter()
+        results = search_index.search(query, limit)
+    logger.info(f"Поиск '{query}': {len(results)} за {(time.perf_counter() - started) * 1000:.2f} мс", extra={
+        'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+    })
+    return results
+
+
 # ===== Команды =====
-@admin_only
+FACET_SUMMARY_LIMIT = 40
+FACET_PAGE_SIZE = 20
+
+
+def format_facets(title, facets):
+    """Заголовок списка проектов/провайдеров со сводкой по каждому"""
+    lines = [title, ""]
+    for f in facets[:FACET_SUMMARY_LIMIT]:
+        line = f"• {esc(f.name)} — {f.count} серв."
+        if f.active_cost > 0:
+            line += f", {f.active_cost:,.0f}₽"
+        if f.nearest_expiry:
+            line += f", ближайший {f.nearest_expiry.strftime('%d.%m.%Y')}"
+        lines.append(line)
+    if len(facets) > FACET_SUMMARY_LIMIT:
+        lines.append(f"... и ещё {len(facets) - FACET_SUMMARY_LIMIT}")
+    return "\n".join(lines)
+
+
+def facet_keyboard(facets, field, offset=0):
+    """Клавиатура фасетов по 2 кнопки в ряд, постранично.
+
+    Каждая кнопка — токен из реестра, поэтому длинные имена не теряются.
+    """
+    page = facets[offset:offset + FACET_PAGE_SIZE]
+    buttons = [
+        InlineKeyboardButton(f"{f.name} ({f.count})", callback_data="@" + callback_tokens.token_for(field, f.name))
+        for f in page
+    ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+
+    nav = []
+    if offset > 0:
+        prev = max(offset - FACET_PAGE_SIZE, 0)
+        token = callback_tokens.token_for('page', f"{field}:{prev}", field=field, offset=prev)
+        nav.append(InlineKeyboardButton("◀️", callback_data="@" + token))
+    if offset + FACET_PAGE_SIZE < len(facets):
+        nxt = offset + FACET_PAGE_SIZE
+        token = callback_tokens.token_for('page', f"{field}:{nxt}", field=field, offset=nxt)
+        nav.append(InlineKeyboardButton("▶️", callback_data="@" + token))
+    if nav:
+        keyboard.append(nav)
+
+    callback_tokens.save()
+    return InlineKeyboardMarkup(keyboard)
+
+@viewer_allowed
 async def start_command(update: Update, context: CallbackContext):
     await update.message.reply_text(
         "👋 <b>Привет! Я бот-нотификатор.</b>\n\n"
@@ -780,7 +2957,7 @@ async def start_command(update: Update, context: CallbackContext):
     )
 
 
-@admin_only
+@viewer_allowed
 async def help_command(update: Update, context: CallbackContext):
     await update.message.reply_text(
         "📚 <b>Справка</b>\n\n"
@@ -798,196 +2975,370 @@ async def help_command(update: Update, context: CallbackContext):
         "• /projects — список проектов\n"
         "• /providers — список провайдеров\n"
         "• /check — проверить истекающие\n"
+        "• /find — поиск сервиса (можно с опечатками)\n"
+        "• /forecast — прогноз расходов на 30/90/365 дней\n"
+        "• /history — история ежедневных проверок (по умолчанию 7 дн.)\n"
+        "• /export — выгрузка в CSV/XLSX (фильтры: project=, provider=, status=, category=, days=)\n"
+        "• /admins — получатели уведомлений и доставка\n"
         "• /test_notify — тест уведомлений\n"
         "• /cleanup_mutex — очистить mutex (Windows)",
         parse_mode='HTML'
     )
 
 
-@admin_only
+def render_status(snapshot, today):
+    """Отчёт /status без строки счётчиков (она меняется чаще снимка)"""
+    counts = snapshot.status_counts()
+    cost = snapshot.costs.total
+
+    # Корзины уже отсортированы: сначала самые просроченные, потом ближайшие
+    buckets = snapshot.classify(today)
+    expired_services = buckets['expired']
+    expiring_services = buckets['expiring']
+    ok_services = buckets['ok']
+
+    msg = (
+        f"📊 <b>Статистика сервисов</b>\n\n"
+        f"📋 Всего: {len(snapshot)}\n"
+        f"🟢 Активных: {counts.get('active', 0)}\n"
+        f"🟡 Ожидают оплаты: {counts.get('notified', 0)}\n"
+        f"🔵 Оплачено: {counts.get('paid', 0)}\n"
+    )
+    if cost > 0:
+        msg += f"💰 Стоимость активных: {cost:,.2f} ₽\n"
+
+    if expired_services:
+        msg += f"\n❌ <b>ИСТЕКЛИ ({len(expired_services)}):</b>\n"
+        for s, exp, days, s_cost in expired_services:
+            project = f" [{esc(s.project)}]" if s.project else ""
+            cost_str = f" • {s_cost:,.0f}₽" if s_cost > 0 else ""
+            msg += f"• {esc(s.name)}{project} — {exp.strftime('%d.%m.%Y')} ({abs(days)} дн. назад){cost_str}\n"
+
+    if expiring_services:
+        msg += f"\n⚠️ <b>СКОРО ИСТЕКУТ ({len(expiring_services)}):</b>\n"
+        for s, exp, days, s_cost in expiring_services:
+            project = f" [{esc(s.project)}]" if s.project else ""
+            cost_str = f" • {s_cost:,.0f}₽" if s_cost > 0 else ""
+            msg += f"• {esc(s.name)}{project} — {exp.strftime('%d.%m.%Y')} (через {days} дн.){cost_str}\n"
+
+    if ok_services:
+        msg += f"\n🟢 <b>В ПОРЯДКЕ ({len(ok_services)}):</b>\n"
+        for s, exp, days, s_cost in ok_services:
+            project = f" [{esc(s.project)}]" if s.project else ""
+            cost_str = f" • {s_cost:,.0f}₽" if s_cost > 0 else ""
+            msg += f"• {esc(s.name)}{project} — {exp.strftime('%d.%m.%Y')} ({days} дн.){cost_str}\n"
+    return split_message(msg)
+
+
+@viewer_allowed
 async def status_command(update: Update, context: CallbackContext):
     """Статистика сервисов из БД с подробным списком"""
     try:
-        services = db_fetch_all_services()
-
-        active = [s for s in services if s.get('status') == 'active']
-        notified_list = [s for s in services if s.get('status') == 'notified']
-        paid_list = [s for s in services if s.get('status') == 'paid']
-        cost = sum(float(s.get('cost', 0)) for s in active if s.get('cost'))
-
+        snapshot = await asyncio.to_thread(get_snapshot)
         today = get_current_date()
-        expired_services = []
-        expiring_services = []
-        ok_services = []
-
-        for s in active:
-            exp = parse_db_date(s.get('expires_at', ''))
-            if not exp:
-                continue
-            days = (exp - today).days
-            entry = (s, exp, days)
-            if days < 0:
-                expired_services.append(entry)
-            elif days <= 30:
-                expiring_services.append(entry)
-            else:
-                ok_services.append(entry)
-
-        # Сортируем: сначала самые просроченные, потом ближайшие
-        expired_services.sort(key=lambda x: x[2])
-        expiring_services.sort(key=lambda x: x[2])
-        ok_services.sort(key=lambda x: x[2])
-
-        msg = (
-            f"📊 <b>Статистика сервисов</b>\n\n"
-            f"📋 Всего: {len(services)}\n"
-            f"🟢 Активных: {len(active)}\n"
-            f"🟡 Ожидают оплаты: {len(notified_list)}\n"
-            f"🔵 Оплачено: {len(paid_list)}\n"
-        )
-        if cost > 0:
-            msg += f"💰 Стоимость активных: {cost:,.2f} ₽\n"
-
-        if expired_services:
-            msg += f"\n❌ <b>ИСТЕКЛИ ({len(expired_services)}):</b>\n"
-            for s, exp, days in expired_services:
-                project = f" [{esc(s.get('project'))}]" if s.get('project') else ""
-                cost_str = f" • {float(s['cost']):,.0f}₽" if s.get('cost') and float(s.get('cost', 0)) > 0 else ""
-                msg += f"• {esc(s['name'])}{project} — {exp.strftime('%d.%m.%Y')} ({abs(days)} дн. назад){cost_str}\n"
-
-        if expiring_services:
-            msg += f"\n⚠️ <b>СКОРО ИСТЕКУТ ({len(expiring_services)}):</b>\n"
-            for s, exp, days in expiring_services:
-                project = f" [{esc(s.get('project'))}]" if s.get('project') else ""
-                cost_str = f" • {float(s['cost']):,.0f}₽" if s.get('cost') and float(s.get('cost', 0)) > 0 else ""
-                msg += f"• {esc(s['name'])}{project} — {exp.strftime('%d.%m.%Y')} (через {days} дн.){cost_str}\n"
-
-        if ok_services:
-            msg += f"\n🟢 <b>В ПОРЯДКЕ ({len(ok_services)}):</b>\n"
-            for s, exp, days in ok_services:
-                project = f" [{esc(s.get('project'))}]" if s.get('project') else ""
-                cost_str = f" • {float(s['cost']):,.0f}₽" if s.get('cost') and float(s.get('cost', 0)) > 0 else ""
-                msg += f"• {esc(s['name'])}{project} — {exp.strftime('%d.%m.%Y')} ({days} дн.){cost_str}\n"
-
-        msg += f"\n📈 Проверок: {total_checks} | Уведомлений: {total_notifications}"
-
-        await send_long_message(update, msg)
+        parts = report_cache.get(('status',), snapshot, lambda: render_status(snapshot, today), today)
+        footer = f"📈 Проверок: {total_checks} | Уведомлений: {total_notifications}"
+        await send_parts(update, append_footer(parts, footer))
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
-@admin_only
+@viewer_allowed
 async def projects_command(update: Update, context: CallbackContext):
     """Список проектов"""
     try:
-        projects = db_fetch_projects()
+        snapshot = await asyncio.to_thread(get_snapshot)
+        projects = snapshot.facets('project')
 
         if not projects:
             await update.message.reply_text("📋 Проектов нет.")
             return
 
-        keyboard = []
-        row = []
-        for i, p in enumerate(projects):
-            cb = f"select_project:{p}"
-            if len(cb.encode('utf-8')) <= 64:
-                row.append(InlineKeyboardButton(p, callback_data=cb))
-            if len(row) == 2 or i == len(projects) - 1:
-                keyboard.append(row)
-                row = []
-
         await update.message.reply_text(
-            "🏢 <b>Проекты:</b>",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            report_cache.get(('projects',), snapshot, lambda: format_facets("🏢 <b>Проекты:</b>", projects)),
+            reply_markup=facet_keyboard(projects, 'project'),
             parse_mode='HTML'
         )
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
-@admin_only
+@viewer_allowed
 async def providers_command(update: Update, context: CallbackContext):
     """Список провайдеров"""
     try:
-        providers = db_fetch_providers()
+        snapshot = await asyncio.to_thread(get_snapshot)
+        providers = snapshot.facets('provider')
 
         if not providers:
             await update.message.reply_text("🌐 Провайдеров нет.")
             return
 
-        keyboard = []
-        row = []
-        for i, p in enumerate(providers):
-            cb = f"select_provider:{p}"
-            if len(cb.encode('utf-8')) <= 64:
-                row.append(InlineKeyboardButton(p, callback_data=cb))
-            if len(row) == 2 or i == len(providers) - 1:
-                keyboard.append(row)
-                row = []
-
         await update.message.reply_text(
-            "🌐 <b>Провайдеры:</b>",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            report_cache.get(('providers',), snapshot, lambda: format_facets("🌐 <b>Провайдеры:</b>", providers)),
+            reply_markup=facet_keyboard(providers, 'provider'),
             parse_mode='HTML'
         )
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
-@admin_only
+def render_check(snapshot, today):
+    """Отчёт /check: истекшие и истекающие активные сервисы"""
+    if not snapshot.status_counts().get('active'):
+        return ["✅ Нет активных сервисов."]
+
+    buckets = snapshot.classify(today)
+    expired = buckets['expired']
+    expiring = buckets['expiring']
+
+    if not expired and not expiring:
+        return ["✅ Все сервисы в порядке! Ближайшие 30 дней без истечений."]
+
+    msg = "🔍 <b>Проверка сервисов</b>\n"
+
+    if expired:
+        msg += f"\n❌ <b>ИСТЕКЛИ ({len(expired)}):</b>\n"
+        for s, exp, days, s_cost in expired:
+            project = f" [{esc(s.project)}]" if s.project else ""
+            provider = f" ({esc(s.provider)})" if s.provider else ""
+            cost_str = f" • {s_cost:,.0f}₽" if s_cost > 0 else ""
+            msg += f"• {esc(s.name)}{project}{provider} — {exp.strftime('%d.%m.%Y')} (<b>{abs(days)} дн. назад</b>){cost_str}\n"
+
+    if expiring:
+        msg += f"\n⚠️ <b>СКОРО ИСТЕКУТ ({len(expiring)}):</b>\n"
+        for s, exp, days, s_cost in expiring:
+            project = f" [{esc(s.project)}]" if s.project else ""
+            provider = f" ({esc(s.provider)})" if s.provider else ""
+            cost_str = f" • {s_cost:,.0f}₽" if s_cost > 0 else ""
+            msg += f"• {esc(s.name)}{project}{provider} — {exp.strftime('%d.%m.%Y')} (<b>через {days} дн.</b>){cost_str}\n"
+
+    msg += f"\n📊 Итого: {len(expired)} истекших, {len(expiring)} скоро"
+    return split_message(msg)
+
+
+@viewer_allowed
 async def check_command(update: Update, context: CallbackContext):
     """Принудительная проверка истекающих с подробным выводом"""
-
     try:
-        active_services = db_fetch_active_services()
-        if not active_services:
-            await update.message.reply_text("✅ Нет активных сервисов.")
-            return
-
+        snapshot = await asyncio.to_thread(get_snapshot)
         today = get_current_date()
-        expired = []
-        expiring = []
+        parts = report_cache.get(('check',), snapshot, lambda: render_check(snapshot, today), today)
+        await send_parts(update, parts)
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
-        for s in active_services:
-            exp = parse_db_date(s.get('expires_at', ''))
-            if not exp:
-                continue
-            days = (exp - today).days
-            if days < 0:
-                expired.append((s, exp, days))
-            elif days <= 30:
-                expiring.append((s, exp, days))
 
-        if not expired and not expiring:
-            await update.message.reply_text("✅ Все сервисы в порядке! Ближайшие 30 дней без истечений.")
+@viewer_allowed
+async def find_command(update: Update, context: CallbackContext):
+    """Нечёткий поиск сервиса: /find <запрос>"""
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text("🔎 Использование: /find <название, проект или провайдер>")
+        return
+    try:
+        results = await asyncio.to_thread(find_services, query)
+        if not results:
+            await update.message.reply_text(f"📭 Ничего не найдено по «{query}»")
             return
+        can_act = has_role(update.message.from_user.id, 'admin')
+        for service, _ in results:
+            await update.message.reply_text(
+                format_service_card(service, "🔎 <b>Найдено</b>", service.days_left(get_current_date())),
+                reply_markup=service_keyboard(service) if can_act else None,
+                parse_mode='HTML'
+            )
+        callback_tokens.save()
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
-        expired.sort(key=lambda x: x[2])
-        expiring.sort(key=lambda x: x[2])
 
-        msg = "🔍 <b>Проверка сервисов</b>\n"
+async def inline_find(update: Update, context: CallbackContext):
+    """Inline-режим: @бот <запрос> — карточки сервисов с кнопками"""
+    query = update.inline_query
+    if not query or not has_role(query.from_user.id, 'viewer') or not query.query.strip():
+        return
+    results = await asyncio.to_thread(find_services, query.query, INLINE_LIMIT)
+    can_act = has_role(query.from_user.id, 'admin')
+    articles = []
+    for service, _ in results:
+        days = service.days_left(get_current_date())
+        description = service.project or service.provider or ""
+        if days is not None:
+            description = f"{description} · {days} дн." if description else f"{days} дн."
+        articles.append(InlineQueryResultArticle(
+            id=str(service.id),
+            title=str(service.name or '?'),
+            description=description,
+            input_message_content=InputTextMessageContent(
+                format_service_card(service, "🔎 <b>Сервис</b>", days), parse_mode='HTML'
+            ),
+            reply_markup=service_keyboard(service) if can_act else None,
+        ))
+    callback_tokens.save()
+    await query.answer(articles, cache_time=0, is_personal=True)
+
+
+@viewer_allowed
+async def forecast_command(update: Update, context: CallbackContext):
+    """Прогноз расходов на продления из материализованных агрегатов"""
+    try:
+        snapshot = await asyncio.to_thread(get_snapshot)
+        today = get_current_date()
+        a = snapshot.costs
+
+        msg = "📈 <b>Прогноз расходов на продления</b>\n\n"
+        msg += f"💰 Активные всего: {a.total:,.2f} ₽\n"
+        overdue = a.overdue(today)
+        if overdue:
+            msg += f"❌ Уже просрочено: {overdue:,.2f} ₽\n"
+        for days in FORECAST_WINDOWS:
+            msg += f"📅 {days} дн.: {a.forecast(today, days):,.2f} ₽\n"
+
+        this_month = today.strftime('%Y-%m')
+        months = sorted(m for m in a.by_month if m >= this_month)[:12]
+        if months:
+            msg += "\n🗓 <b>По месяцам окончания:</b>\n"
+            for m in months:
+                msg += f"• {m}: {a.by_month[m]:,.2f} ₽\n"
+
+        top = sorted(a.by_project.items(), key=lambda x: x[1], reverse=True)[:5]
+        if top:
+            msg += "\n🏢 <b>Топ проектов:</b>\n"
+            for name, cost in top:
+                msg += f"• {esc(name)}: {cost:,.2f} ₽\n"
 
-        if expired:
-            msg += f"\n❌ <b>ИСТЕКЛИ ({len(expired)}):</b>\n"
-            for s, exp, days in expired:
-                project = f" [{esc(s.get('project'))}]" if s.get('project') else ""
-                provider = f" ({esc(s.get('provider'))})" if s.get('provider') else ""
-                cost_str = f" • {float(s['cost']):,.0f}₽" if s.get('cost') and float(s.get('cost', 0)) > 0 else ""
-                msg += f"• {esc(s['name'])}{project}{provider} — {exp.strftime('%d.%m.%Y')} (<b>{abs(days)} дн. назад</b>){cost_str}\n"
+        await send_long_message(update, msg)
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
-        if expiring:
-            msg += f"\n⚠️ <b>СКОРО ИСТЕКУТ ({len(expiring)}):</b>\n"
-            for s, exp, days in expiring:
-                project = f" [{esc(s.get('project'))}]" if s.get('project') else ""
-                provider = f" ({esc(s.get('provider'))})" if s.get('provider') else ""
-                cost_str = f" • {float(s['cost']):,.0f}₽" if s.get('cost') and float(s.get('cost', 0)) > 0 else ""
-                msg += f"• {esc(s['name'])}{project}{provider} — {exp.strftime('%d.%m.%Y')} (<b>через {days} дн.</b>){cost_str}\n"
 
-        msg += f"\n📊 Итого: {len(expired)} истекших, {len(expiring)} скоро"
+@viewer_allowed
+async def history_command(update: Update, context: CallbackContext):
+    """Тренды прогонов планировщика: /history [дней]"""
+    try:
+        days = int(context.args[0]) if context.args else HISTORY_DEFAULT_DAYS
+    except ValueError:
+        await update.message.reply_text("Использование: /history [дней]")
+        return
+    days = max(1, min(days, HISTORY_RETENTION_DAYS))
+    try:
+        runs = await asyncio.to_thread(run_history.runs, days)
+        if not runs:
+            await update.message.reply_text(f"🗂 За {days} дн. прогонов не было.")
+            return
+        await send_long_message(update, format_history(runs, days))
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
-        await send_long_message(update, msg)
+
+HISTORY_TYPE_LABELS = {"expired": "💀", "daily": "🔥", "one_week": "🚨", "two_weeks": "⚠️", "month": "📅"}
+
+
+def format_history(runs, days):
+    """Сводка по дням: длительность ежедневной проверки, объём, отправки, ошибки"""
+    by_day = OrderedDict()
+    for r in runs:
+        by_day.setdefault(r['started_at'][:10], []).append(r)
+
+    msg = f"🗂 <b>История прогонов за {days} дн.</b>\n\n"
+    durations = []
+    totals = Counter()
+    for day, day_runs in by_day.items():
+        checks = [r for r in day_runs if r['kind'] == 'check']
+        sent = sum(r['sent'] for r in day_runs)
+        types = Counter()
+        for r in day_runs:
+            types.update(r['by_type'])
+        totals.update(types)
+        errors = sum(r['db_errors'] + r['send_errors'] for r in day_runs)
+        retries = sum(r['retries'] for r in day_runs)
+
+        line = f"<b>{datetime.fromisoformat(day).strftime('%d.%m')}</b>:"
+        if checks:
+            avg = sum(r['duration_ms'] for r in checks) / len(checks) / 1000
+            durations.append(avg)
+            line += f" ⏱ {avg:.1f} с"
+            if len(checks) > 1:
+                line += f" (×{len(checks)}, макс {max(r['duration_ms'] for r in checks) / 1000:.1f} с)"
+            line += f" · строк {max(r['rows'] for r in checks)}"
+        line += f" · ✉️ {sent}"
+        if types:
+            line += " (" + " ".join(f"{HISTORY_TYPE_LABELS.get(t, t)}{n}" for t, n in types.most_common()) + ")"
+        if any(not r['complete'] for r in checks):
+            line += " · ⛔ не завершена"
+        if errors or retries:
+            line += f" · ⚠️ ошибок {errors}, повторов {retries}"
+        msg += line + "\n"
+
+    if len(durations) >= 2 and durations[0] > 0:
+        change = (durations[-1] - durations[0]) / durations[0]
+        msg += f"\n📈 Длительность проверки: {durations[0]:.1f} с → {durations[-1]:.1f} с ({change:+.0%})"
+    if totals:
+        msg += f"\n✉️ Всего отправлено: {sum(totals.values())}"
+    return msg
+
+
+@viewer_allowed
+async def export_command(update: Update, context: CallbackContext):
+    """Выгрузка сервисов в CSV/XLSX: /export [csv|xlsx] [project=..] [provider=..] [status=..] [category=..] [days=N]"""
+    try:
+        fmt, filters = parse_export_args(shlex.split(update.message.text)[1:])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {esc(str(e))}\n\n"
+            "Формат: /export [csv|xlsx] [project=..] [provider=..] [status=..] [category=..] [days=N]",
+            parse_mode='HTML'
+        )
+        return
+    if fmt == "xlsx" and Workbook is None:
+        await update.message.reply_text("❌ Для XLSX нужен пакет openpyxl. Используйте /export csv.")
+        return
+
+    path = None
+    try:
+        await update.message.reply_text("⏳ Готовлю выгрузку...")
+        started = time.monotonic()
+        path, rows = await asyncio.to_thread(write_export, fmt, filters)
+        logger.info(f"Экспорт {fmt}: {rows} строк", extra={
+            'rows': rows,
+            'duration_ms': round((time.monotonic() - started) * 1000, 1),
+        })
+        filename = f"services_{get_current_date().isoformat()}.{fmt}"
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f, filename=filename,
+                caption=f"📦 Сервисов: {rows}"
+            )
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+@admin_only
+async def admins_command(update: Update, context: CallbackContext):
+    """Получатели уведомлений, роли и статистика доставки"""
+    msg = "👥 <b>Получатели и роли</b>\n\n"
+    chats = list(dict.fromkeys(BROADCAST_CHATS + VIEWER_IDS))
+    for chat_id in chats:
+        role = ROLES.get(chat_id, 'group' if chat_id < 0 else '—')
+        line = f"• <code>{chat_id}</code> — {role}"
+        if chat_id in BROADCAST_CHATS:
+            stats = delivery_stats.get(chat_id)
+            if stats:
+                line += f" | ✅ {stats['ok']} ❌ {stats['failed']}"
+                if stats['last_error']:
+                    line += f"\n   ⚠️ {esc(stats['last_error'][:100])}"
+        else:
+            line += " | без рассылки"
+        msg += line + "\n"
+    msg += (
+        f"\n📈 Кэш отчётов: {report_cache.hit_rate():.0%} попаданий "
+        f"({report_cache.hits}/{report_cache.hits + report_cache.misses})"
+    )
+    await send_long_message(update, msg)
 
 
 @admin_only
@@ -1024,7 +3375,7 @@ async def cleanup_mutex_command(update: Update, context: CallbackContext):
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
-@admin_only
+@viewer_allowed
 async def handle_text(update: Update, context: CallbackContext):
     """Ответ на любые текстовые сообщения"""
     await update.message.reply_text(
@@ -1035,35 +3386,146 @@ async def handle_text(update: Update, context: CallbackContext):
 
 
 # ===== Планировщик =====
+async def sleep_or_stop(seconds):
+    """Пауза, которая прерывается запросом остановки. True — если остановка"""
+    if shutdown_event is None:
+        await asyncio.sleep(seconds)
+        return stop_requested
+    try:
+        await asyncio.wait_for(shutdown_event.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
+    return stop_requested
+
+
+# Дата последней полностью обработанной проверки (водяной знак).
+# Хранится в data/, чтобы после простоя догнать пропущенные дни
+SCHEDULER_STATE_FILE = os.path.join(DATA_DIR, 'scheduler_state.json')
+FIXED_REMINDER_DAYS = {30: "month", 14: "two_weeks", 7: "one_week"}
+last_check_date = None
+
+
+def load_scheduler_state():
+    """Загружает водяной знак планировщика"""
+    global last_check_date
+    try:
+        if os.path.exists(SCHEDULER_STATE_FILE):
+            with open(SCHEDULER_STATE_FILE, 'r') as f:
+                last_check_date = parse_db_date(json.load(f).get('last_processed_date'))
+            logger.info(f"Последняя обработанная дата: {last_check_date}")
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить состояние планировщика: {e}")
+
+
+def save_scheduler_state(processed_date):
+    """Сохраняет водяной знак планировщика"""
+    global last_check_date
+    last_check_date = processed_date
+    try:
+        os.makedirs(os.path.dirname(SCHEDULER_STATE_FILE), exist_ok=True)
+        with open(SCHEDULER_STATE_FILE, 'w') as f:
+            json.dump({'last_processed_date': processed_date.isoformat()}, f)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить состояние планировщика: {e}")
+
+
+def find_missed_reminders(snapshot, first_day, last_day, today):
+    """Напоминания за 30/14/7 дней, которые должны были уйти в [first_day, last_day].
+
+    Один проход по активным сервисам: за окно пропуска «дней до окончания»
+    пробегают отрезок [exp - last_day, exp - first_day], и порог попал в окно,
+    если лежит в этом отрезке. Сервисы, о которых сегодня и так придёт
+    обычное уведомление, и уже уведомлённые после порога пропускаются.
+    Возвращает список (row, notification_type, days_left_today).
+    """
+    missed = []
+    buckets = snapshot.classify(today)
+    for entries in buckets.values():
+        for s, exp, days, _ in entries:
+            if days in FIXED_REMINDER_DAYS or days <= 5:
+                continue  # сегодняшний прогон уведомит сам
+            lo, hi = (exp - last_day).days, (exp - first_day).days
+            hits = [t for t in FIXED_REMINDER_DAYS if lo <= t <= hi]
+            if not hits:
+                continue
+            threshold = min(hits)  # самый свежий из пропущенных
+            notified = s.notification_date
+            if notified and notified >= exp - timedelta(days=threshold):
+                continue
+            missed.append((s, FIXED_REMINDER_DAYS[threshold], days))
+    missed.sort(key=lambda x: x[2])
+    return missed
+
+
+async def catch_up_missed_days(today):
+    """Отправляет одной сводкой напоминания, пропущенные за время простоя"""
+    if last_check_date is None or not BROADCAST_CHATS:
+        return
+    first_day = last_check_date + timedelta(days=1)
+    last_day = today - timedelta(days=1)
+    if first_day > last_day:
+        return
+
+    snapshot = await asyncio.to_thread(get_snapshot, 0)
+    missed = find_missed_reminders(snapshot, first_day, last_day, today)
+    logger.info(f"Догоняющая проверка {first_day}..{last_day}: пропущено {len(missed)} напоминаний")
+    if missed:
+        labels = {"month": "за месяц", "two_weeks": "за 2 недели", "one_week": "за неделю"}
+        msg = (
+            f"📬 <b>Пропущенные напоминания</b>\n"
+            f"🗓 {first_day.strftime('%d.%m.%Y')} — {last_day.strftime('%d.%m.%Y')}\n\n"
+        )
+        for s, ntype, days in missed:
+            project = f" [{esc(s.project)}]" if s.project else ""
+            msg += f"• {esc(s.name or '?')}{project} — {labels[ntype]}, осталось {days} дн.\n"
+        for part in split_message(msg):
+            if not await broadcast(part, parse_mode='HTML'):
+                # Водяной знак не сдвигаем — сводку отправим при следующей попытке
+                raise RuntimeError("сводка пропущенных напоминаний никому не доставлена")
+    save_scheduler_state(last_day)
+
+
 async def start_notification_scheduler_async():
     """Асинхронный планировщик: проверка в 9:00 МСК"""
-    global scheduler_running
-    last_check_date = None
     logger.info("📅 Планировщик запущен (9:00 МСК)")
 
+    last_deferred_flush = time.monotonic()
     while scheduler_running:
         try:
             now = get_current_datetime()
             today = now.date()
+            # Пропущен день (простой или проверка падала весь день) — сначала
+            # догоняем его, иначе водяной знак перепрыгнет через него
+            if last_check_date is not None and last_check_date < today - timedelta(days=1):
+                try:
+                    await catch_up_missed_days(today)
+                except Exception as e:
+                    logger.error(f"Ошибка догоняющей проверки: {e}")
+                    await sleep_or_stop(300)
+                    continue
             # Проверяем: час >= 9 И ещё не проверяли сегодня
             if now.hour >= 9 and last_check_date != today:
                 logger.info("⏰ Запуск ежедневной проверки уведомлений")
                 try:
-                    await check_and_send_notifications()
-                    last_check_date = today
+                    if not await check_and_send_notifications():
+                        raise RuntimeError("проверка не завершена")
+                    save_scheduler_state(today)
                     logger.info("✅ Ежедневная проверка завершена")
                 except Exception as e:
                     logger.error(f"Ошибка при проверке уведомлений: {e}")
                     # Не ставим last_check_date — попробуем снова через 5 мин
-                    await asyncio.sleep(300)
+                    await sleep_or_stop(300)
                     continue
+            if len(deferred_reminders) and time.monotonic() - last_deferred_flush >= DEFERRED_RETRY_INTERVAL:
+                last_deferred_flush = time.monotonic()
+                await flush_deferred_reminders()
             write_healthcheck()
-            await asyncio.sleep(30)
+            await sleep_or_stop(30)
         except asyncio.CancelledError:
             break
         except Exception as e:
             logger.error(f"Ошибка планировщика: {e}")
-            await asyncio.sleep(60)
+            await sleep_or_stop(60)
 
     logger.info("📅 Планировщик остановлен")
 
@@ -1073,21 +3535,677 @@ async def error_handler(update: object, context: CallbackContext) -> None:
     """Глобальный обработчик ошибок для python-telegram-bot"""
     error = context.error
     if isinstance(error, NetworkError):
-        logger.warning(f"Сетевая ошибка (авто-retry): {error}")
+        logger.warning(f"Сетевая ошибка (авто-retry): {error}", extra={'rate_key': 'network'})
     elif isinstance(error, TimedOut):
-        logger.warning(f"Таймаут (авто-retry): {error}")
+        logger.warning(f"Таймаут (авто-retry): {error}", extra={'rate_key': 'timeout'})
     elif isinstance(error, RetryAfter):
         logger.warning(f"Flood control — ждём {error.retry_after} сек")
     else:
         logger.error(f"Ошибка обработки update: {error}", exc_info=context.error)
 
 
-# ===== Событие остановки (threading — работает между event loop) =====
-stop_event = threading.Event()
+# ===== Событие остановки =====
+# stop_requested переживает перезапуск main() в run_bot,
+# shutdown_event создаётся заново в каждом event loop
+stop_requested = False
+shutdown_event = None
+
+
+def request_stop(signum=None):
+    """Запрашивает остановку бота (из обработчика сигнала или кода)"""
+    global stop_requested, scheduler_running
+    if signum is not None:
+        logger.info(f"Сигнал {signum}, останавливаю...")
+    stop_requested = True
+    scheduler_running = False
+    if shutdown_event is not None:
+        shutdown_event.set()
+
+
+def install_signal_handlers(loop):
+    """SIGINT/SIGTERM будят event loop через shutdown_event"""
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_stop, sig)
+        except (NotImplementedError, RuntimeError):
+            # Windows: обработчик сигнала должен передать управление в loop
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(request_stop, signum))
+
+
+# ===== Супервизор компонентов =====
+COMPONENT_BASE_DELAY = 0.5  # секунд
+COMPONENT_MAX_DELAY = 60.0
+COMPONENT_HEALTHY_AFTER = 60.0  # после стольких секунд работы счётчик сбоев сбрасывается
+POLLER_CHECK_INTERVAL = 5.0
+DB_PING_INTERVAL = 60.0
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))  # секунд на плавную остановку
+
+
+class Supervisor:
+    """Следит за компонентами бота внутри одного event loop.
+
+    Каждый компонент — корутина-фабрика в собственной задаче. Упавший
+    (или неожиданно завершившийся) компонент перезапускается отдельно
+    с экспоненциальной задержкой; остальные компоненты, кэши и соединения
+    при этом не трогаются.
+    """
+
+    def __init__(self):
+        self._components = []
+        self._tasks = {}
+        self._stopping = set()
+        self.restarts = {}
+
+    def add(self, name, factory):
+        self._components.append((name, factory))
+        self.restarts[name] = 0
+
+    def _stopped(self, name):
+        # После сигнала компоненты завершаются сами, ещё до drain()
+        return stop_requested or name in self._stopping
+
+    async def _watch(self, name, factory):
+        failures = 0
+        while not self._stopped(name):
+            started = time.monotonic()
+            try:
+                await factory()
+                if self._stopped(name):
+                    return
+                raise RuntimeError("компонент завершился")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._stopped(name):
+                    return
+                if time.monotonic() - started > COMPONENT_HEALTHY_AFTER:
+                    failures = 0
+                failures += 1
+                self.restarts[name] += 1
+                delay = min(COMPONENT_BASE_DELAY * (2 ** (failures - 1)), COMPONENT_MAX_DELAY)
+                logger.error(
+                    f"💥 Компонент {name} упал: {e} — перезапуск через {delay:.1f} сек",
+                    extra={'component': name, 'failures': failures}
+                )
+                await asyncio.sleep(delay)
+
+    def start(self):
+        for name, factory in self._components:
+            self._tasks[name] = asyncio.create_task(self._watch(name, factory), name=f"component:{name}")
+
+    async def drain(self, name, timeout):
+        """Даёт компоненту завершиться самому (до timeout сек), затем отменяет"""
+        self._stopping.add(name)
+        task = self._tasks.get(name)
+        if not task or task.done():
+            return True
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+        if not done:
+            logger.warning(f"Компонент {name} не завершился за {timeout:.1f} сек — отменяю")
+        await self.stop([name])
+        return bool(done)
+
+    async def stop(self, names=None):
+        """Отменяет компоненты (по умолчанию все, в обратном порядке регистрации)"""
+        for name, _ in reversed(self._components):
+            if names is not None and name not in names:
+                continue
+            self._stopping.add(name)
+            task = self._tasks.get(name)
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e:
+                    logger.error(f"Ошибка остановки компонента {name}: {e}")
+
+
+@db_query
+def db_ping():
+    """Лёгкий запрос для проверки соединения с БД"""
+    return get_supabase().table("digital_notificator_services").select("id").limit(1).execute()
+
+
+async def run_db_monitor():
+    """Компонент БД: держит соединение тёплым и переподключается при сбоях"""
+    while True:
+        await asyncio.to_thread(db_ping)
+        await asyncio.sleep(DB_PING_INTERVAL)
+
+
+async def run_poller(application):
+    """Компонент polling: запускает updater и следит, что он жив"""
+    if not application.updater.running:
+        await application.updater.start_polling(
+            drop_pending_updates=True,
+            allowed_updates=Update.ALL_TYPES
+        )
+        if 'polling' not in startup_metrics:
+            startup_metrics['polling'] = time.monotonic() - startup_metrics['started']
+            logger.info(
+                f"⚡ Polling запущен через {startup_metrics['polling']:.3f} сек",
+                extra={'duration_ms': round(startup_metrics['polling'] * 1000, 1)}
+            )
+    while True:
+        await asyncio.sleep(POLLER_CHECK_INTERVAL)
+        if not application.updater.running:
+            raise RuntimeError("updater остановлен")
+
+
+# ===== Поток изменений =====
+# Изменения, сделанные другим приложением, применяются к снимку сразу,
+# а изменённые строки проверяются по правилам уведомлений, не дожидаясь
+# завтрашней проверки. CHANGE_FEED=realtime — Supabase Realtime (таблица
+# должна быть в публикации supabase_realtime), CHANGE_FEED=postgres —
+# LISTEN/NOTIFY на CHANGE_FEED_DSN (триггер — в README).
+try:
+    import asyncpg
+except ImportError:  # asyncpg нужен только для CHANGE_FEED=postgres
+    asyncpg = None
+
+CHANGE_FEED_CHECK_INTERVAL = 30  # секунд между проверками, что подписка жива
+CHANGE_FEED_POLL = 1.0  # как часто цикл замечает остановку
+
+
+@contextlib.asynccontextmanager
+async def realtime_feed(queue):
+    """Подписка Supabase Realtime; отдаёт функцию проверки, что она жива"""
+    from supabase import acreate_client
+    from realtime.types import RealtimeSubscribeStates
+
+    client = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    channel = client.channel("services-feed")
+    failures = []
+
+    def on_change(payload):
+        data = payload.get('data') or {}
+        queue.put_nowait((data.get('type'), data.get('record'), data.get('old_record')))
+
+    def on_state(state, error):
+        if state != RealtimeSubscribeStates.SUBSCRIBED:
+            failures.append(error or state)
+
+    channel.on_postgres_changes("*", schema="public", table="digital_notificator_services", callback=on_change)
+    await channel.subscribe(on_state)
+    try:
+        yield lambda: not failures and client.realtime.is_connected
+    finally:
+        try:
+            await client.remove_channel(channel)
+            await client.realtime.close()
+        except Exception as e:
+            logger.debug(f"Ошибка закрытия Realtime: {e}")
+
+
+@contextlib.asynccontextmanager
+async def postgres_feed(queue):
+    """LISTEN на CHANGE_FEED_CHANNEL; payload — JSON {op, record, old}"""
+    if asyncpg is None:
+        raise RuntimeError("для CHANGE_FEED=postgres нужен пакет asyncpg")
+    conn = await asyncpg.connect(CHANGE_FEED_DSN)
+
+    def on_notify(connection, pid, channel, payload):
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Некорректное уведомление {channel}: {payload[:200]}")
+            return
+        queue.put_nowait((change.get('op'), change.get('record'), change.get('old')))
+
+    await conn.add_listener(CHANGE_FEED_CHANNEL, on_notify)
+    try:
+        yield lambda: not conn.is_closed()
+    finally:
+        await conn.close()
+
+
+def collapse_changes(changes):
+    """Последнее состояние каждой строки пачки: (изменённые Service, удалённые id)"""
+    upserts = {}
+    deleted = set()
+    for op, record, old in changes:
+        if op == 'DELETE':
+            sid = (old or {}).get('id')
+            if sid is not None:
+                deleted.add(sid)
+                upserts.pop(sid, None)
+        elif record and record.get('id') is not None:
+            upserts[record['id']] = record
+            deleted.discard(record['id'])
+    return Service.from_rows(upserts.values()), deleted
+
+
+async def apply_service_changes(changes):
+    """Применяет пачку изменений к снимку и уведомляет по изменённым строкам"""
+    services, deleted = collapse_changes(changes)
+    await asyncio.to_thread(patch_snapshot, services, deleted)
+    for s in services:
+        logger.debug(f"Изменение из потока: {s!r}")
+
+    today = get_current_date()
+    # До сегодняшней проверки изменённые строки проверит она сама
+    if last_check_date != today or not BROADCAST_CHATS:
+        return 0
+    active = [s for s in services if s.status == 'active']
+    by_type, deferred, _ = await send_planned(plan_notifications(active, today), today)
+    sent = sum(by_type.values())
+    if sent or deferred:
+        deferred_reminders.save()
+    if sent:
+        update_statistics(notifications_increment=sent)
+        callback_tokens.save()
+        message_registry.save()
+        logger.info(f"Уведомлений по изменениям из потока: {sent}")
+    return sent
+
+
+async def run_change_feed():
+    """Компонент потока изменений: подписка и обработка пачками"""
+    queue = asyncio.Queue()
+    feed = realtime_feed if CHANGE_FEED == "realtime" else postgres_feed
+    async with feed(queue) as alive:
+        logger.info(f"📡 Поток изменений подключён ({CHANGE_FEED})")
+        last_check = time.monotonic()
+        # Остановка не отменяет обработку посреди отправки: цикл выходит сам
+        while not stop_requested:
+            try:
+                first = await asyncio.wait_for(queue.get(), CHANGE_FEED_POLL)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_check >= CHANGE_FEED_CHECK_INTERVAL:
+                    last_check = time.monotonic()
+                    if not alive():
+                        raise RuntimeError("подписка на изменения потеряна")
+                continue
+            changes = [first]
+            while not queue.empty():
+                changes.append(queue.get_nowait())
+            try:
+                await apply_service_changes(changes)
+            except Exception as e:
+                # Строки подтянутся следующей выборкой снимка
+                logger.error(f"Ошибка обработки изменений: {e}")
+                invalidate_snapshot()
+
+
+# ===== Пробный прогон уведомлений =====
+# python main.py --dry-run services.csv --as-of 2026-11-01 — план ежедневной
+# проверки на выгрузке (JSON/JSONL/CSV или SQLite с таблицей сервисов)
+# без Telegram и Supabase. Результат — JSON в stdout.
+def load_service_rows(path):
+    """Строки сервисов из файла: .json (список), .jsonl, .csv, .db/.sqlite"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            return list(csv.DictReader(f))
+    if ext == '.jsonl':
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    if ext in ('.db', '.sqlite', '.sqlite3'):
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        try:
+            return [dict(r) for r in conn.execute("SELECT * FROM digital_notificator_services")]
+        finally:
+            conn.close()
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def dry_run(path, as_of):
+    """План уведомлений и записей в БД на дату as_of"""
+    started = time.perf_counter()
+    # Миллион строк без циклических ссылок: сборщик мусора здесь только тратит время
+    gc.disable()
+    try:
+        rows = load_service_rows(path)
+        loaded = time.perf_counter()
+        # Та же выборка, что db_fetch_active_services()
+        services = Service.from_rows([r for r in rows if r.get('status') == 'active'])
+        parsed = time.perf_counter()
+        plan = plan_notifications(services, as_of)
+        planned = time.perf_counter()
+    finally:
+        gc.enable()
+
+    notifications = [
+        {
+            "service_id": service.id,
+            "name": service.name,
+            "type": notification_type,
+            "days_left": days,
+            "priority": priority,
+            "deferrable": priority >= DEFERRABLE_PRIORITY,
+            "write": notification_write(notification_type, as_of),
+        }
+        for priority, days, service, notification_type in plan
+    ]
+    return {
+        "as_of": as_of.isoformat(),
+        "rows": len(rows),
+        "active": len(services),
+        "summary": dict(Counter(n["type"] for n in notifications)),
+        "notifications": notifications,
+        "timing_ms": {
+            "load": round((loaded - started) * 1000, 1),
+            "parse": round((parsed - loaded) * 1000, 1),
+            "plan": round((planned - parsed) * 1000, 1),
+        },
+    }
+
+
+# ===== Параллельная обработка обновлений =====
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "8"))  # обработчиков одновременно
+HEAVY_UPDATE_CONCURRENCY = int(os.getenv("HEAVY_UPDATE_CONCURRENCY", "2"))  # из них — тяжёлых отчётов
+UPDATE_BACKLOG = 256  # обновлений в обработке и ожидании слота
+# Команды с полной выборкой и длинным ответом
+HEAVY_COMMANDS = frozenset({"status", "check", "projects", "providers", "forecast", "export", "test_notify"})
+
+
+def is_heavy_update(update):
+    """Тяжёлый отчёт — команда из HEAVY_COMMANDS; всё остальное интерактивное"""
+    message = getattr(update, 'message', None)
+    text = message.text if message is not None and message.text else ""
+    if not text.startswith('/'):
+        return False
+    command = text[1:].split(maxsplit=1)[0].split('@', 1)[0].lower() if len(text) > 1 else ""
+    return command in HEAVY_COMMANDS
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка с приоритетом интерактивных обновлений.
+
+    Всего одновременно UPDATE_CONCURRENCY обработчиков, тяжёлые отчёты
+    занимают не больше HEAVY_UPDATE_CONCURRENCY из них — остальные слоты
+    всегда свободны для кнопок и коротких команд. Тяжёлые ждут своей
+    очереди, не занимая общий слот. Порядок действий над одним сервисом
+    обеспечивают service_locks.
+    """
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY, heavy_concurrency=HEAVY_UPDATE_CONCURRENCY):
+        super().__init__(UPDATE_BACKLOG)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._heavy = asyncio.Semaphore(max(1, min(heavy_concurrency, concurrency - 1)))
+
+    async def do_process_update(self, update, coroutine):
+        if is_heavy_update(update):
+            async with self._heavy, self._slots:
+                await coroutine
+        else:
+            async with self._slots:
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ===== Запись и воспроизведение трафика =====
+# RECORD_FILE=data/trace.jsonl.gz — писать входящие обновления, вызовы Bot API
+# и ответы Supabase (с длительностью) в локальный лог.
+# python main.py --replay data/trace.jsonl.gz [--speed 10] — прогнать лог через
+# настоящие обработчики без сети и БД и вывести задержки.
+RECORD_FILE = os.getenv("RECORD_FILE")
+RECORD_PARAM_LIMIT = 300  # символов на параметр Bot API в логе
+
+traffic_recorder = None
+traffic_replay = None
+
+
+def _open_trace(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _jsonable(value):
+    """Результат db-функции в JSON: ответ postgrest сворачиваем до .data"""
+    if hasattr(value, 'data') and not isinstance(value, (dict, list)):
+        return {'__response__': value.data}
+    return value
+
+
+class TrafficRecorder:
+    """Пишет события в JSONL: {'t': сек от старта, 'kind': ..., ...}.
+
+    Вызывается из event loop и из потоков БД, поэтому запись под блокировкой.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = _open_trace(path, 'w')
+        self.record('start', at=get_current_datetime_iso())
+
+    def record(self, kind, **fields):
+        event = {'t': round(time.monotonic() - self.started, 4), 'kind': kind, **fields}
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file:
+                self._file.write(line + '\n')
+
+    def record_db(self, name, args, result, duration):
+        self.record('db', fn=name, args=list(args), result=_jsonable(result), ms=round(duration * 1000, 1))
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+        logger.info(f"Запись трафика сохранена: {self.path}")
+
+
+class RecordingRequest(HTTPXRequest):
+    """HTTPXRequest, который дублирует каждый вызов Bot API в TrafficRecorder"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        started = time.monotonic()
+        code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        if traffic_recorder is not None:
+            params = {
+                k: v[:RECORD_PARAM_LIMIT]
+                for k, v in ((request_data.json_parameters if request_data else {}) or {}).items()
+            }
+            try:
+                response = json.loads(payload)
+            except ValueError:
+                response = None
+            traffic_recorder.record(
+                'api', method=url.rsplit('/', 1)[-1], params=params, code=code,
+                response=response, ms=round((time.monotonic() - started) * 1000, 1)
+            )
+        return code, payload
+
+
+async def _record_update(update: object, context: CallbackContext):
+    if traffic_recorder is not None and isinstance(update, Update):
+        traffic_recorder.record('update', update=update.to_dict())
+
+
+class TrafficReplay:
+    """Лента записанных ответов: Bot API и db-функции отдают их по порядку.
+
+    Ответы ищутся по (имя, аргументы), затем по имени; когда записанные
+    закончились, повторяется последний. Задержки воспроизводятся с
+    коэффициентом speed.
+    """
+
+    def __init__(self, events, speed=1.0):
+        self.speed = speed
+        self.api = defaultdict(list)
+        self.db = defaultdict(list)
+        self.last = {}
+        self.calls = Counter()
+        for e in events:
+            if e['kind'] == 'api':
+                self.api[e['method']].append(e)
+            elif e['kind'] == 'db':
+                self.db[(e['fn'], json.dumps(e['args'], default=str))].append(e)
+                self.db[e['fn']].append(e)
+        self._used = set()  # запись db лежит в двух лентах — отдаём её один раз
+        self._next_message_id = 1
+
+    def _take(self, tape, key):
+        entries = tape.get(key)
+        while entries:
+            event = entries.pop(0)
+            if id(event) not in self._used:
+                self._used.add(id(event))
+                self.last[key] = event
+                return event
+        return self.last.get(key)
+
+    def db_result(self, name, args):
+        self.calls[name] += 1
+        event = self._take(self.db, (name, json.dumps(list(args), default=str)))
+        if event is None:
+            event = self._take(self.db, name)
+        if event is None:
+            return None
+        time.sleep(event['ms'] / 1000 / self.speed)
+        result = event['result']
+        if isinstance(result, dict) and '__response__' in result:
+            return SimpleNamespace(data=result['__response__'])
+        return result
+
+    def api_response(self, method, params):
+        self.calls[method] += 1
+        event = self._take(self.api, method)
+        if event is not None and event.get('response') is not None:
+            return event['response'], event['ms']
+        # Записи нет — синтезируем минимально правдоподобный ответ
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'replay', 'username': 'replay_bot'}
+        elif method.startswith('send'):
+            self._next_message_id += 1
+            result = {
+                'message_id': self._next_message_id, 'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}, 'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return {'ok': True, 'result': result}, 0.0
+
+
+class ReplayRequest(BaseRequest):
+    """Сетевой слой PTB, отвечающий из записанной ленты"""
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        params = (request_data.json_parameters if request_data else {}) or {}
+        response, ms = self.replay.api_response(url.rsplit('/', 1)[-1], params)
+        if ms:
+            await asyncio.sleep(ms / 1000 / self.replay.speed)
+        return 200, json.dumps(response).encode()
+
+
+def load_trace(path):
+    with _open_trace(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def use_data_dir(path):
+    """Переносит все файлы состояния в path (воспроизведение не трогает data/ бота)"""
+    global DATA_DIR, STATS_FILE, SCHEDULER_STATE_FILE, HEALTHCHECK_FILE
+    DATA_DIR = path
+    STATS_FILE = os.path.join(path, 'stats.json')
+    SCHEDULER_STATE_FILE = os.path.join(path, 'scheduler_state.json')
+    HEALTHCHECK_FILE = os.path.join(path, 'healthcheck')
+    callback_tokens.path = os.path.join(path, 'callback_tokens.json')
+    message_registry.path = os.path.join(path, 'messages.json')
+    run_history.path = os.path.join(path, 'history.sqlite')
+    deferred_reminders.path = os.path.join(path, 'deferred.json')
+
+
+async def replay_main(path, speed):
+    """Прогоняет запись через настоящие обработчики и печатает задержки"""
+    global bot_application, outbound, traffic_replay, clock_shift, shutdown_event
+
+    events = load_trace(path)
+    if not events or events[0]['kind'] != 'start':
+        logger.error(f"{path}: не похоже на запись трафика")
+        return
+    # Синтетические message_id и статистика не должны попасть в data/ бота
+    scratch = tempfile.TemporaryDirectory(prefix='replay-')
+    use_data_dir(scratch.name)
+    traffic_replay = TrafficReplay(events, speed)
+    clock_shift = datetime.fromisoformat(events[0]['at']) - datetime.now(MSK)
+    shutdown_event = asyncio.Event()
+
+    application = build_application(ReplayRequest(traffic_replay), ReplayRequest(traffic_replay))
+    bot_application = application
+    await application.initialize()
+    await application.start()
+    outbound = OutboundSender()
+    sender_task = asyncio.create_task(outbound.run())
+
+    latencies = defaultdict(list)
+
+    async def timed(label, coro):
+        started = time.monotonic()
+        try:
+            await coro
+        finally:
+            latencies[label].append(time.monotonic() - started)
+
+    tasks = []
+    started = time.monotonic()
+    for event in events:
+        if event['kind'] not in ('update', 'job'):
+            continue
+        delay = event['t'] / speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if event['kind'] == 'update':
+            update = Update.de_json(event['update'], application.bot)
+            label = next((k for k in event['update'] if k != 'update_id'), 'update')
+            processing = application.update_processor.process_update(update, application.process_update(update))
+            tasks.append(asyncio.create_task(timed(label, processing)))
+        elif event['name'] == 'check':
+            tasks.append(asyncio.create_task(timed('job:check', check_and_send_notifications())))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    total = time.monotonic() - started
+
+    sender_task.cancel()
+    await asyncio.gather(sender_task, return_exceptions=True)
+    await application.stop()
+    await application.shutdown()
+
+    lines = [f"Воспроизведение {path}: {len(tasks)} событий за {total:.2f} сек (x{speed:g})"]
+    for label, values in sorted(latencies.items()):
+        lines.append(
+            f"  {label:<16} n={len(values):<5} p50={_percentile(values, 0.5) * 1000:8.1f} мс "
+            f"p95={_percentile(values, 0.95) * 1000:8.1f} мс max={max(values) * 1000:8.1f} мс"
+        )
+    lines.append("  вызовы: " + ", ".join(f"{k}={v}" for k, v in traffic_replay.calls.most_common()))
+    print("\n".join(lines))
+    scratch.cleanup()
 
 
 # ===== Main =====
-HEALTHCHECK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'healthcheck')
+HEALTHCHECK_FILE = os.path.join(DATA_DIR, 'healthcheck')
 
 def write_healthcheck():
     """Обновляет файл healthcheck с текущим timestamp"""
@@ -1099,24 +4217,108 @@ def write_healthcheck():
         pass
 
 
-async def main():
-    global bot_application
+startup_metrics = {}
 
-    if not validate_config():
-        return
 
-    load_stats()
+async def _startup_checks_with_timeout():
+    try:
+        await asyncio.wait_for(run_startup_checks(), timeout=30.0)
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ Timeout при отправке уведомления о запуске")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось отправить уведомление о запуске: {e}")
+
+
+async def _track_first_update(update: object, context: CallbackContext):
+    """Фиксирует время от старта main() до первого входящего обновления"""
+    if 'first_update' not in startup_metrics and 'started' in startup_metrics:
+        startup_metrics['first_update'] = time.monotonic() - startup_metrics['started']
+        logger.info(
+            f"⚡ Первое обновление через {startup_metrics['first_update']:.3f} сек после старта",
+            extra={'duration_ms': round(startup_metrics['first_update'] * 1000, 1)}
+        )
+
 
-    application = (
+async def drain(application, supervisor, startup_task):
+    """Плавная остановка за DRAIN_TIMEOUT сек.
+
+    1. Перестаём принимать новую работу: polling и обработка апдейтов.
+    2. Даём планировщику закончить текущую пару «отправка + запись в БД».
+    3. Ждём незавершённые callback-операции.
+    4. Отправляем уведомление об остановке и выгребаем очередь отправки.
+    5. Сохраняем статистику и токены, гасим оставшиеся компоненты.
+    """
+    global traffic_recorder
+    started = time.monotonic()
+    deadline = started + DRAIN_TIMEOUT
+
+    def remaining():
+        return max(0.0, deadline - time.monotonic())
+
+    if startup_task and not startup_task.done():
+        startup_task.cancel()
+        try:
+            await startup_task
+        except asyncio.CancelledError:
+            pass
+
+    await supervisor.stop(["poller"])
+    try:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+    except Exception as e:
+        logger.error(f"Ошибка остановки polling: {e}")
+
+    # Поток изменений и планировщик сами завершают начатые отправки и отметки
+    await supervisor.drain("changefeed", remaining())
+    await supervisor.drain("scheduler", remaining())
+    await supervisor.stop(["db"])
+    if not await inflight.wait_idle(remaining()):
+        logger.warning(f"Не дождались {inflight.count} операций")
+
+    try:
+        await asyncio.wait_for(send_bot_stop_notification(), remaining())
+    except Exception as e:
+        logger.warning(f"Уведомление об остановке не отправлено: {e}")
+    if outbound is not None and outbound.running:
+        try:
+            await asyncio.wait_for(outbound.queue.join(), remaining())
+        except asyncio.TimeoutError:
+            logger.warning(f"В очереди отправки осталось {outbound.queue.qsize()} сообщений")
+
+    save_stats()
+    callback_tokens.save()
+    message_registry.save()
+    await supervisor.stop()
+    if traffic_recorder is not None:
+        traffic_recorder.close()
+        traffic_recorder = None
+    logger.info(f"Drain завершён за {time.monotonic() - started:.2f} сек")
+
+
+def build_application(request=None, get_updates_request=None):
+    """Создаёт Application и регистрирует обработчики.
+
+    request — свой сетевой слой PTB (запись или воспроизведение трафика).
+    """
+    builder = (
         Application.builder()
-        .token(TELEGRAM_BOT_TOKEN)
-        .connect_timeout(30.0)
-        .read_timeout(30.0)
-        .write_timeout(30.0)
-        .pool_timeout(30.0)
-        .build()
+        .token(TELEGRAM_BOT_TOKEN or "0:replay")
+        .concurrent_updates(PriorityUpdateProcessor())
     )
-    bot_application = application
+    if request is not None:
+        builder = builder.request(request)
+    else:
+        builder = builder.connect_timeout(30.0).read_timeout(30.0).write_timeout(30.0).pool_timeout(30.0)
+    if get_updates_request is not None:
+        builder = builder.get_updates_request(get_updates_request)
+    application = builder.build()
+
+    # Метрика времени до первого обновления (группа -1 — до остальных обработчиков)
+    application.add_handler(TypeHandler(Update, _track_first_update), group=-1)
+    application.add_handler(TypeHandler(Update, _record_update), group=-2)
 
     # Команды
     application.add_handler(CommandHandler("start", start_command))
@@ -1125,6 +4327,11 @@ async def main():
     application.add_handler(CommandHandler("projects", projects_command))
     application.add_handler(CommandHandler("providers", providers_command))
     application.add_handler(CommandHandler("check", check_command))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("forecast", forecast_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("admins", admins_command))
     application.add_handler(CommandHandler("test_notify", test_notify_command))
     application.add_handler(CommandHandler("cleanup_mutex", cleanup_mutex_command))
 
@@ -1134,86 +4341,110 @@ async def main():
     # Callback-кнопки
     application.add_handler(CallbackQueryHandler(handle_all_callbacks))
 
+    # Inline-поиск (нужно включить inline-режим у @BotFather)
+    application.add_handler(InlineQueryHandler(inline_find))
+
     # Глобальный обработчик ошибок
     application.add_error_handler(error_handler)
 
+    return application
+
+
+async def main():
+    global bot_application, bot_start_time, outbound, shutdown_event, traffic_recorder
+
+    startup_metrics.clear()
+    startup_metrics['started'] = time.monotonic()
+    bot_start_time = get_current_datetime()
+
+    if not validate_config():
+        return
+
+    shutdown_event = asyncio.Event()
+    if stop_requested:
+        shutdown_event.set()
+    install_signal_handlers(asyncio.get_running_loop())
+
+    load_stats()
+    load_scheduler_state()
+    callback_tokens.load()
+    message_registry.load()
+    deferred_reminders.load()
+
+    if RECORD_FILE:
+        if traffic_recorder is None:
+            traffic_recorder = TrafficRecorder(RECORD_FILE)
+        logger.info(f"📼 Запись трафика в {RECORD_FILE}")
+        application = build_application(RecordingRequest(
+            connect_timeout=30.0, read_timeout=30.0, write_timeout=30.0, pool_timeout=30.0
+        ))
+    else:
+        application = build_application()
+    bot_application = application
+
+
     logger.info("🤖 Бот запущен")
     await application.initialize()
 
-    # Уведомление о запуске
+    outbound = OutboundSender()
+    supervisor = Supervisor()
+    # Порядок важен: останавливаются в обратном порядке, очередь отправки — последней
+    supervisor.add("sender", outbound.run)
+    supervisor.add("db", run_db_monitor)
+    supervisor.add("poller", lambda: run_poller(application))
+    supervisor.add("scheduler", start_notification_scheduler_async)
+    if CHANGE_FEED:
+        supervisor.add("changefeed", run_change_feed)
+
+    startup_task = None
     try:
-        await asyncio.wait_for(send_bot_start_notification(), timeout=30.0)
-    except asyncio.TimeoutError:
-        logger.warning("⚠️ Timeout при отправке уведомления о запуске")
-    except Exception as e:
-        logger.warning(f"⚠️ Не удалось отправить уведомление о запуске: {e}")
-
-    scheduler_task = None
-    try:
-        scheduler_task = asyncio.create_task(start_notification_scheduler_async())
-
         await application.start()
-        await application.updater.start_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
-        )
+        supervisor.start()
+
+        # Уведомление о запуске и проверка — в фоне, не задерживая polling
+        startup_task = asyncio.create_task(_startup_checks_with_timeout())
 
         # Ждём сигнала остановки
-        while not stop_event.is_set():
-            await asyncio.sleep(1)
+        await shutdown_event.wait()
     except asyncio.CancelledError:
         pass
     except Exception as e:
         logger.error(f"Ошибка main loop: {e}", exc_info=True)
     finally:
         logger.info("Завершение...")
-        if scheduler_task and not scheduler_task.done():
-            scheduler_task.cancel()
-            try:
-                await scheduler_task
-            except asyncio.CancelledError:
-                pass
-        try:
-            await send_bot_stop_notification()
-        except Exception:
-            pass
+        await drain(application, supervisor, startup_task)
         try:
-            if application.updater and application.updater.running:
-                await application.updater.stop()
-            if application.running:
-                await application.stop()
             await application.shutdown()
         except Exception as e:
             logger.error(f"Ошибка остановки: {e}")
 
 
 def run_bot():
-    """Запуск бота с автоперезапуском при падении (exponential backoff)"""
+    """Запуск бота с автоперезапуском при падении (exponential backoff).
+
+    Сбои отдельных компонентов обрабатывает Supervisor внутри main();
+    сюда доходят только ошибки инициализации (например, Telegram недоступен).
+    """
     global bot_application, scheduler_running
 
     MAX_RETRIES = 10
     BASE_DELAY = 5  # секунд
     MAX_DELAY = 300  # 5 минут макс
 
-    def signal_handler(signum, frame):
-        logger.info(f"Сигнал {signum}, останавливаю...")
-        scheduler_running = False
-        stop_event.set()
-
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    # До запуска event loop сигналы просто выставляют флаг остановки
+    signal.signal(signal.SIGINT, lambda signum, frame: request_stop(signum))
+    signal.signal(signal.SIGTERM, lambda signum, frame: request_stop(signum))
 
     retries = 0
-    while retries < MAX_RETRIES:
+    while retries < MAX_RETRIES and not stop_requested:
         try:
-            stop_event.clear()
             scheduler_running = True
             bot_application = None
             asyncio.run(main())
-            # Если main() завершился нормально (по stop_event) — выходим
-            if stop_event.is_set():
+            # main() завершается нормально только по сигналу или при ошибке конфигурации
+            if stop_requested:
                 logger.info("Бот остановлен по сигналу")
-                break
+            break
         except KeyboardInterrupt:
             logger.info("Остановка по Ctrl+C")
             break
@@ -1236,6 +4467,20 @@ def run_bot():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бот уведомлений о сервисах")
+    parser.add_argument("--replay", metavar="FILE", help="воспроизвести запись трафика (RECORD_FILE) без сети и БД")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение воспроизведения (по умолчанию 1)")
+    parser.add_argument("--dry-run", metavar="FILE", help="план уведомлений по выгрузке сервисов, без Telegram и БД")
+    parser.add_argument("--as-of", type=date.fromisoformat, help="дата пробного прогона (по умолчанию сегодня, МСК)")
+    cli_args = parser.parse_args()
+    if cli_args.dry_run:
+        report = dry_run(cli_args.dry_run, cli_args.as_of or get_current_date())
+        # json.dumps без indent идёт через C-энкодер — на миллионе строк это важно
+        sys.stdout.write(json.dumps(report, ensure_ascii=False, default=str) + "\n")
+        sys.exit(0)
+    if cli_args.replay:
+        asyncio.run(replay_main(cli_args.replay, cli_args.speed))
+        sys.exit(0)
     if check_single_instance():
         sys.exit(1)
     run_bot()
@@ -0,0 +1,29 @@
+import tempfile
+
+import main
+
+main.use_data_dir(tempfile.mkdtemp())
+
+
+def _service(sid, name, provider='Beget'):
+    return {'id': sid, 'name': name, 'project': 'p', 'provider': provider,
+            'status': 'active', 'expires_at': '2027-01-01'}
+
+
+def _index(rows):
+    index = main.SearchIndex()
+    index.apply(main.ServiceSnapshot(main.Service.from_rows(rows), 1))
+    return index
+
+
+def test_prefix_finds_exact_matches_past_candidate_cap():
+    # Редкая хвостовая триграмма 'de ' не должна вытеснять сотни точных совпадений
+    rows = [_service(i, f'Yandex Cloud {i}', 'Yandex') for i in range(main.FIND_MAX_CANDIDATES * 2 + 100)]
+    rows += [_service(10_000, 'Node hosting'), _service(10_001, 'Claude')]
+    names = [row.name for row, _ in _index(rows).search('yande')]
+    assert names == ['Yandex Cloud 0', 'Yandex Cloud 1', 'Yandex Cloud 10', 'Yandex Cloud 100', 'Yandex Cloud 101']
+
+
+def test_typo_still_matches():
+    rows = [_service(i, f'Yandex Cloud {i}', 'Yandex') for i in range(50)] + [_service(100, 'Claude')]
+    assert _index(rows).search('cloude')[0][0].name == 'Claude'